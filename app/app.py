@@ -1,31 +1,143 @@
 import os
 import logging
-from apistar import http, exceptions, Include, Command
+from apistar import http, exceptions, Include, Route, Command, Component
 from apistar.backends import sqlalchemy_backend
+from apistar.backends.sqlalchemy_backend import (
+    Session, SQLAlchemyBackend, get_session
+)
+from apistar.core import flatten_routes
 from apistar.frameworks.asyncio import ASyncIOApp
 from apistar.handlers import docs_urls, static_urls
 from apistar.permissions import IsAuthenticated
 from projects.routes import routes as projects_routes
 from users.routes import routes as users_routes
 from tokens.routes import routes as tokens_routes
+from metrics import metrics, public_metrics
+from batch import batch
 from db_base import Base
+from database import PooledBackend
+from async_session import SessionPool, AsyncSession, WriteBatcher
+from cache import Cache, LocalMemoryCache
+from compression import Compressor, header
+from encoders import Encoder, JSONRenderer, get_encoder
+from instrumentation import Metrics, Span, current_span
 from server import run
-from migrations.commands import revision, upgrade, downgrade
+from benchmarks import benchmark
+from migrations.commands import (
+    revision, upgrade, downgrade, report_slow_filters
+)
 from tokens.routes import TokenAuthentication
+from users.passwords import PasswordHasher
 
 settings = {
     "AUTHENTICATION": [TokenAuthentication()],
     "PERMISSIONS": [IsAuthenticated()],
     "JWT_SECRET": os.environ['JWT_SECRET'],
+    "PASSWORD_HASHING": {
+        "CONTEXT": {
+            "schemes": ['pbkdf2_sha512'],
+            "pbkdf2_sha512__default_rounds": int(
+                os.environ.get('PASSWORD_ROUNDS', 25000)),
+        },
+        "WORKERS": os.cpu_count(),
+        "MAX_PENDING": 100,
+    },
     "DATABASE": {
         "URL": 'postgresql://{e[DB_USER]}:{e[DB_PASSWORD]}@{e[DB_HOST]}/{e[DB_NAME]}'  # nopep8
                .format(e=os.environ),
-        "METADATA": Base.metadata
-    }
+        "METADATA": Base.metadata,
+        "POOL_SIZE": int(os.environ.get('DB_POOL_SIZE', 5)),
+        "MAX_OVERFLOW": int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        "POOL_TIMEOUT": 30,
+        "POOL_RECYCLE": 1800,
+        "POOL_PRE_PING": True,
+        "STATEMENT_TIMEOUT": int(os.environ.get('DB_STATEMENT_TIMEOUT', 0)),
+        "STATEMENT_TIMEOUTS": {},
+        "SLOW_FILTER_TIME": int(os.environ.get('DB_SLOW_FILTER_TIME', 500)),
+        "SLOW_QUERY_TIME": int(os.environ.get('DB_SLOW_QUERY_TIME', 1000)),
+        "WRITE_BATCH_WINDOW": int(os.environ.get('DB_WRITE_BATCH_WINDOW', 0)),
+        "WRITE_BATCH_SIZE": 100,
+    },
+    "CACHE": {
+        "SIZE": int(os.environ.get('CACHE_SIZE', 10000)),
+        "TTL": int(os.environ.get('CACHE_TTL', 60)),
+        "WORKERS_TTL": int(os.environ.get('CACHE_WORKERS_TTL', 0)),
+    },
+    "JSON_ENCODER": os.environ.get('JSON_ENCODER', 'auto'),
+    "METRICS": {
+        "PUBLIC": os.environ.get('METRICS_PUBLIC') == 'true',
+    },
+    "COMPRESSION": {
+        "MIN_SIZE": int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)),
+        "OFFLOAD_SIZE": 64 * 1024,
+        "LEVELS": {
+            "gzip": int(os.environ.get('GZIP_LEVEL', 6)),
+            "br": int(os.environ.get('BROTLI_LEVEL', 4)),
+            "zstd": int(os.environ.get('ZSTD_LEVEL', 3)),
+        },
+    },
 }
 
 
+class StreamingReply():
+    """
+    Wraps a reply channel so that responses whose content is an async
+    iterator are sent as a chunked body, one chunk per item, and bodies
+    are compressed with the negotiated `encoding`.
+    """
+    def __init__(self, reply, compressor, encoding=None):
+        self.reply = reply
+        self.compressor = compressor
+        self.encoding = encoding
+        self.status = None
+
+    async def send(self, message):
+        self.status = message.get('status', self.status)
+        if 'headers' in message:
+            message = await self.compressor.apply(message, self.encoding)
+        content = message.get('content')
+        if not hasattr(content, '__aiter__'):
+            return await self.reply.send(message)
+
+        await self.reply.send(
+            dict(message, content=b'', more_content=True))
+        async for chunk in content:
+            await self.reply.send({'content': chunk, 'more_content': True})
+        await self.reply.send({'content': b'', 'more_content': False})
+
+
 class App(ASyncIOApp):
+    def __init__(self, **kwargs):
+        kwargs['settings'].setdefault('RENDERERS', [JSONRenderer()])
+        super().__init__(**kwargs)
+        self.encoder = self.preloaded_state[Encoder]
+        self.metrics = self.preloaded_state[Metrics]
+        self.compressor = self.preloaded_state[Compressor]
+        self.route_names = {
+            view: name
+            for path, method, view, name in flatten_routes(kwargs['routes'])
+        }
+
+    async def __call__(self, message, channels):
+        encoding = self.compressor.negotiate(
+            header(message.get('headers', []), b'accept-encoding'))
+        reply = StreamingReply(channels['reply'], self.compressor, encoding)
+        method = message['method'].upper()
+        span = Span(self.route_name(message['path'], method), method)
+        token = current_span.set(span)
+        try:
+            await super().__call__(message, dict(channels, reply=reply))
+        finally:
+            current_span.reset(token)
+            self.metrics.observe(span, reply.status)
+
+    def route_name(self, path, method):
+        try:
+            handler, kwargs = self.router.lookup(path, method)
+        except exceptions.HTTPException:
+            return 'unmatched'
+        return self.route_names.get(handler, handler.__name__)
+
     def exception_handler(self, exc: Exception) -> http.Response:
         if isinstance(exc, exceptions.Found):
             return http.Response(
@@ -51,6 +163,10 @@ routes = [
     users_routes,
     projects_routes,
     tokens_routes,
+    Route('/metrics', 'GET',
+          public_metrics if settings['METRICS']['PUBLIC'] else metrics,
+          name='metrics'),
+    Route('/batch', 'POST', batch),
     Include('/docs', docs_urls),
     Include('/static', static_urls)
 ]
@@ -64,8 +180,21 @@ app = App(
         Command('make_migrations', revision),
         Command('migrate', upgrade),
         Command('revert_migrations', downgrade),
+        Command('report_slow_filters', report_slow_filters),
+        Command('benchmark', benchmark),
     ],
-    components=sqlalchemy_backend.components
+    components=[
+        Component(SQLAlchemyBackend, init=PooledBackend),
+        Component(Session, init=get_session, preload=False),
+        Component(SessionPool),
+        Component(WriteBatcher),
+        Component(AsyncSession, preload=False),
+        Component(PasswordHasher),
+        Component(Cache, init=LocalMemoryCache),
+        Component(Metrics),
+        Component(Compressor),
+        Component(Encoder, init=get_encoder),
+    ]
 )
 
 
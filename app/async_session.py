@@ -0,0 +1,231 @@
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from apistar import Settings
+from apistar.core import flatten_routes
+from apistar.backends.sqlalchemy_backend import SQLAlchemyBackend
+from apistar.types import Handler, RouteConfig
+from instrumentation import current_span, tracking
+
+
+class SessionPool():
+    """
+    Runs blocking SQLAlchemy work on a thread pool sized to the
+    connection pool, so handlers don't stall the event loop.
+
+    Every `run` call gets its own session, which is committed on success,
+    rolled back on error and closed afterwards.
+    """
+    def __init__(
+        self,
+        backend: SQLAlchemyBackend,
+        settings: Settings,
+        routes: RouteConfig
+    ):
+        database = settings['DATABASE']
+        workers = (
+            database.get('POOL_SIZE', 5) + database.get('MAX_OVERFLOW', 10)
+        )
+        timeouts = database.get('STATEMENT_TIMEOUTS', {})
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.timeouts = {
+            view: timeouts[name]
+            for path, method, view, name in flatten_routes(routes)
+            if name in timeouts
+        }
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+
+    async def run(self, func, *args, timeout=None):
+        loop = asyncio.get_event_loop()
+        call = functools.partial(
+            self.run_sync, func, *args, timeout=timeout,
+            span=current_span.get())
+        return await loop.run_in_executor(self.executor, call)
+
+    async def stream(self, func, *args, timeout=None, buffer=4):
+        """
+        Runs a generator function on the thread pool and yields its items
+        as they are produced, at most `buffer` items ahead of the consumer.
+        """
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        slots = threading.Semaphore(buffer)
+        cancelled = threading.Event()
+        done = object()
+
+        def put(item):
+            while not slots.acquire(timeout=0.1):
+                if cancelled.is_set():
+                    return False
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+            return True
+
+        def produce(session, *args):
+            try:
+                for item in func(session, *args):
+                    if cancelled.is_set() or not put(item):
+                        return
+            except Exception as exc:
+                put(exc)
+                raise
+            put(done)
+
+        task = asyncio.ensure_future(self.run(produce, *args, timeout=timeout))
+        task.add_done_callback(lambda task: task.exception())
+        try:
+            while True:
+                item = await queue.get()
+                slots.release()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+
+    def run_sync(self, func, *args, timeout=None, span=None):
+        session = self.backend.Session()
+        start = time.perf_counter()
+        try:
+            with tracking(span):
+                self.checkout(session)
+                if timeout:
+                    session.execute(
+                        'SET LOCAL statement_timeout = {:d}'.format(timeout))
+                result = func(session, *args)
+                session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            if span is not None:
+                span.db += time.perf_counter() - start
+
+    def checkout(self, session):
+        start = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+        try:
+            session.connection()
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                self.checkouts += 1
+                self.wait_time += time.monotonic() - start
+
+    def stats(self):
+        pool = self.backend.engine.pool
+        stats = {
+            'waiting': self.waiting,
+            'checkouts': self.checkouts,
+            'wait_time': self.wait_time,
+        }
+        for key in ['size', 'checkedout', 'overflow']:
+            if hasattr(pool, key):
+                stats[key] = getattr(pool, key)()
+        return stats
+
+
+def run_batch(session, writes):
+    results = []
+    for func, args in writes:
+        try:
+            with session.begin_nested():
+                results.append((True, func(session, *args)))
+        except Exception as exc:
+            results.append((False, exc))
+    return results
+
+
+class WriteBatcher():
+    """
+    Coalesces writes arriving within `WRITE_BATCH_WINDOW` milliseconds of
+    the first one, up to `WRITE_BATCH_SIZE` of them, into one transaction
+    so they share a commit. Each write runs in its own savepoint and gets
+    its own result or exception.
+
+    Batched writes must flush rather than commit. A window of 0 disables
+    batching.
+    """
+    def __init__(self, pool: SessionPool, settings: Settings):
+        database = settings['DATABASE']
+        self.pool = pool
+        self.window = database.get('WRITE_BATCH_WINDOW', 0) / 1000
+        self.size = database.get('WRITE_BATCH_SIZE', 100)
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+        self.writes = 0
+
+    async def run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((func, args, future))
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self.commit(batch))
+
+    async def commit(self, batch):
+        self.batches += 1
+        self.writes += len(batch)
+        try:
+            results = await self.pool.run(
+                run_batch, [(func, args) for func, args, future in batch])
+        except Exception as exc:
+            results = [(False, exc)] * len(batch)
+        for (func, args, future), (ok, value) in zip(batch, results):
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+class AsyncSession():
+    """
+    A per-request handle on the `SessionPool`, carrying the statement
+    timeout configured for the route being served.
+
+    `write` goes through the `WriteBatcher` when batching is enabled, in
+    which case the route's statement timeout doesn't apply.
+    """
+    def __init__(
+        self,
+        pool: SessionPool,
+        batcher: WriteBatcher,
+        handler: Handler
+    ):
+        self.pool = pool
+        self.batcher = batcher
+        self.timeout = pool.timeouts.get(handler)
+
+    async def run(self, func, *args):
+        return await self.pool.run(func, *args, timeout=self.timeout)
+
+    async def write(self, func, *args):
+        if self.batcher.window:
+            return await self.batcher.run(func, *args)
+        return await self.run(func, *args)
+
+    def stream(self, func, *args):
+        return self.pool.stream(func, *args, timeout=self.timeout)
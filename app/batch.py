@@ -0,0 +1,119 @@
+import json
+from apistar import http
+from apistar.exceptions import BadRequest, HTTPException, TypeSystemError
+from apistar.interfaces import Auth
+from sqlalchemy.exc import DBAPIError
+from async_session import AsyncSession
+from cache import Cache
+from rest_utils import (
+    resources, prepare, create_row, update_row, delete_row, invalidate
+)
+from users.passwords import PasswordHasher
+
+
+MAX_OPERATIONS = 1000
+
+STATUSES = {'create': 201, 'update': 200, 'delete': 204}
+
+
+def parse_operations(body):
+    """
+    Parses a JSON array of `{"op", "resource", "id", "data"}` objects and
+    validates them. Returns the operations as `(op, model, id, data)`
+    tuples, or raises BadRequest with the errors by position.
+    """
+    try:
+        items = json.loads(body.decode())
+    except ValueError:
+        raise BadRequest()
+    if not isinstance(items, list) or len(items) > MAX_OPERATIONS:
+        raise BadRequest()
+
+    operations, errors = [], {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = 'Must be an object.'
+            continue
+        op, id = item.get('op'), item.get('id')
+        model = resources.get(item.get('resource'))
+        if op not in STATUSES:
+            errors[index] = 'Unknown operation.'
+            continue
+        if model is None:
+            errors[index] = 'Unknown resource.'
+            continue
+        if op != 'create' and (not isinstance(id, int) or
+                               isinstance(id, bool)):
+            errors[index] = 'Must have an integer id.'
+            continue
+        data = None
+        if op != 'delete':
+            if 'data' in item and not isinstance(item['data'], dict):
+                errors[index] = 'Data must be an object.'
+                continue
+            try:
+                data = model._scheme(item.get('data', {}))
+            except TypeSystemError as exc:
+                errors[index] = exc.detail
+                continue
+        operations.append((op, model, id, data))
+    if errors:
+        raise BadRequest({'errors': errors})
+    return operations
+
+
+def apply(session, operations):
+    """
+    Applies `operations` in order. The first one to fail aborts the whole
+    transaction, with its position added to the error.
+    """
+    results = []
+    for index, (op, model, id, data) in enumerate(operations):
+        try:
+            if op == 'create':
+                results.append(create_row(session, model, data))
+            elif op == 'update':
+                results.append(update_row(session, model, id, data))
+            else:
+                results.append(delete_row(session, model, id))
+        except HTTPException as exc:
+            raise type(exc)(
+                {'index': index, 'message': exc.detail}, exc.status_code)
+        except DBAPIError:
+            raise BadRequest(
+                {'index': index, 'message': 'Could not be applied.'})
+    return results
+
+
+async def batch(
+    body: http.Body,
+    auth: Auth,
+    session: AsyncSession,
+    hasher: PasswordHasher,
+    cache: Cache
+):
+    """
+    Runs create, update and delete operations on any resource in a single
+    transaction, and returns the status and body of each one.
+    """
+    operations = parse_operations(body)
+    for op, model, id, data in operations:
+        if op != 'delete':
+            await prepare(model, op, [data], auth, hasher)
+
+    touched = [(model, id) for op, model, id, data in operations if id]
+    try:
+        results = await session.run(apply, operations)
+    finally:
+        for model, id in touched:
+            invalidate(cache, model, [id])
+
+    rendered = []
+    for (op, model, id, data), result in zip(operations, results):
+        if op == 'create':
+            invalidate(cache, model, [result['id']])
+        item = {'status': STATUSES[op]}
+        if result is not None:
+            item['body'] = result
+        rendered.append(item)
+    return rendered
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import timeit
+import platform
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import jwt
+import requests
+from faker import Faker
+from apistar import Settings
+from utils import get_component
+from encoders import Encoder
+from rest_utils import bind, Filters, Ordering
+from users.models import User
+from projects.models import Project
+
+
+fake = Faker()
+
+
+def percentile(samples, q):
+    """
+    Nearest-rank percentile of already sorted `samples`.
+    """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+
+def summarize(latencies, elapsed, errors):
+    samples = sorted(latency * 1000 for latency in latencies)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'rps': len(samples) / elapsed if elapsed else None,
+        'mean_ms': sum(samples) / len(samples) if samples else None,
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+    }
+
+
+def load(call, total, concurrency):
+    """
+    Makes `total` calls of `call(session, number)` from `concurrency`
+    threads, each with its own HTTP session, and summarizes their
+    latencies. Responses with a 4xx or 5xx status count as errors.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def run(number):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = call(local.session, number)
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+            if response.status_code >= 400:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(run, range(total)))
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+
+def mint_token(secret, user_id):
+    expires = datetime.now() + timedelta(hours=1)
+    return jwt.encode(
+        {'user_id': user_id, 'exp': int(expires.timestamp()),
+         'jti': fake.uuid4()},
+        secret, algorithm='HS256'
+    ).decode('utf-8')
+
+
+def http_benchmarks(url, secret, total, concurrency):
+    """
+    Seeds a user and projects through the API, then load tests the
+    project CRUD routes, `create_token` and token authentication.
+    """
+    email, password = fake.email(), fake.password()
+    owner = requests.post(url + '/users/', json={
+        'first_name': fake.first_name(), 'last_name': fake.last_name(),
+        'email': email, 'password': password,
+    }).json()
+    headers = {
+        'Authorization': 'Bearer {}'.format(mint_token(secret, owner['id']))}
+    seeded = requests.post(url + '/projects/bulk', headers=headers, json=[
+        {'name': fake.word()} for _ in range(2 * total)
+    ]).json()['ids']
+    viewed, deleted = seeded[:total], seeded[total:]
+    login = {'grant_type': 'password', 'username': email, 'password': password}
+
+    scenarios = [
+        ('list_projects', total, lambda session, n: session.get(
+            url + '/projects/?limit=50', headers=headers)),
+        ('view_project', total, lambda session, n: session.get(
+            url + '/projects/{}'.format(viewed[n]), headers=headers)),
+        ('create_project', total, lambda session, n: session.post(
+            url + '/projects/', json={'name': fake.word()},
+            headers=headers)),
+        ('update_project', total, lambda session, n: session.patch(
+            url + '/projects/{}'.format(viewed[n]),
+            json={'name': fake.word()}, headers=headers)),
+        ('delete_project', total, lambda session, n: session.delete(
+            url + '/projects/{}'.format(deleted[n]), headers=headers)),
+        ('create_token', max(1, total // 10), lambda session, n: session.post(
+            url + '/tokens/', json=login)),
+        ('authenticate_uncached', total, lambda session, n: session.get(
+            url + '/projects/?limit=1&count=none', headers={
+                'Authorization': 'Bearer {}'.format(
+                    mint_token(secret, owner['id']))})),
+    ]
+    return {
+        name: load(call, count, concurrency)
+        for name, count, call in scenarios
+    }
+
+
+def time_call(func, number):
+    """
+    Microseconds per call of `func`, best of three runs.
+    """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def micro_benchmarks(number):
+    """
+    Times rendering and query parameter parsing without a database.
+    """
+    user = User(id=1, first_name='Ada', last_name='Byron', email='a@b.c')
+    projects = [Project(id=i, name='p{}'.format(i), user_id=1)
+                for i in range(100)]
+    serializer = Project.serializer()
+    encoder = get_component(Encoder)
+    filters = bind(Filters, User)
+    ordering = bind(Ordering, User)
+    condition = 'first_name==Ada;last_name~contains~By,email==a@b.c'
+    return {
+        'render_us': time_call(user.render, number),
+        'dumps_100_us': time_call(
+            lambda: serializer.dumps(projects, encoder),
+            max(1, number // 100)),
+        'filters_uncached_us': time_call(
+            lambda: filters.compiler.parse(condition), number),
+        'filters_cached_us': time_call(lambda: filters(condition), number),
+        'ordering_us': time_call(lambda: ordering('-last_name'), number),
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(url: str='http://127.0.0.1:8080',
+              count: int=500,
+              concurrency: int=10,
+              number: int=10000,
+              output: str='benchmark.json',
+              micro_only: bool=False):
+    """
+    Benchmark the API and save the results as JSON.
+
+    Run the server against a throwaway database first, it is written to.
+
+    Args:
+      url: The root URL of the running server.
+      count: The number of requests per scenario.
+      concurrency: The number of concurrent clients.
+      number: The number of calls per micro-benchmark.
+      output: The file to save the results to.
+      micro_only: Skip the HTTP load tests.
+    """
+    results = {
+        'revision': revision(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'micro': micro_benchmarks(number),
+    }
+    if not micro_only:
+        results['http'] = http_benchmarks(
+            url.rstrip('/'), get_component(Settings)['JWT_SECRET'],
+            count, concurrency)
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    return json.dumps(results, indent=2, sort_keys=True)
@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+from apistar import Settings
+
+
+class Cache():
+    """
+    Interface for the cache of rendered objects used by the generated
+    routes. Implementations need `get`, `generation`, `set`, `delete`,
+    `clear` and `stats`.
+
+    A reader takes `generation(key)` before loading a value and passes it
+    to `set`, which drops the value if `key` was deleted in between, so a
+    read racing a write can't cache the old value.
+
+    `share(workers)` is called before the app is forked into `workers`
+    processes.
+    """
+    def get(self, key):
+        raise NotImplementedError()
+
+    def generation(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, value, generation=None):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        raise NotImplementedError()
+
+    def share(self, workers):
+        pass
+
+
+class LocalMemoryCache(Cache):
+    """
+    An in-process LRU cache whose entries expire after `TTL` seconds.
+
+    Every worker process keeps its own copy, so a write served by one
+    worker can leave others serving the old value until it expires. With
+    more than one worker the TTL is `WORKERS_TTL` instead, which is 0 (no
+    caching) unless set.
+    """
+    def __init__(self, settings: Settings):
+        config = settings.get('CACHE', {})
+        self.size = config.get('SIZE', 10000)
+        self.ttl = config.get('TTL', 60)
+        self.workers_ttl = config.get('WORKERS_TTL', 0)
+        self.entries = OrderedDict()
+        self.deleted = OrderedDict()
+        self.counter = 0
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def generation(self, key):
+        return self.counter
+
+    def set(self, key, value, generation=None):
+        if self.ttl <= 0:
+            return
+        if generation is not None and (
+                generation < self.floor or
+                self.deleted.get(key, 0) > generation):
+            return
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+        self.counter += 1
+        self.deleted[key] = self.counter
+        self.deleted.move_to_end(key)
+        while len(self.deleted) > self.size:
+            self.floor = self.deleted.popitem(last=False)[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.counter += 1
+        self.floor = self.counter
+        self.deleted.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def share(self, workers):
+        if workers > 1:
+            self.ttl = min(self.ttl, self.workers_ttl)
+            self.clear()
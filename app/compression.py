@@ -0,0 +1,212 @@
+import zlib
+import asyncio
+from collections import OrderedDict
+from apistar import Settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Encoding():
+    name = None
+    level = None
+    available = True
+
+    def __init__(self, level):
+        self.level = level
+
+
+class Gzip(Encoding):
+    name = 'gzip'
+    level = 6
+
+    def compress(self, data):
+        stream = self.stream()
+        return stream.compressor.compress(data) + stream.finish()
+
+    def stream(self):
+        return GzipStream(self.level)
+
+
+class GzipStream():
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return (self.compressor.compress(data) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class Brotli(Encoding):
+    name = 'br'
+    level = 4
+    available = brotli is not None
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self):
+        return BrotliStream(self.level)
+
+
+class BrotliStream():
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class Zstd(Encoding):
+    name = 'zstd'
+    level = 3
+    available = zstandard is not None
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self):
+        return ZstdStream(self.level)
+
+
+class ZstdStream():
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return (self.compressor.compress(data) +
+                self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+ENCODINGS = [Brotli, Zstd, Gzip]
+
+
+def header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+class Compressor():
+    """
+    Compresses response bodies with the best encoding the client accepts,
+    preferring brotli, then zstd, then gzip among those installed.
+
+    Bodies smaller than `MIN_SIZE` bytes are sent as they are, and bodies
+    or streamed chunks of `OFFLOAD_SIZE` bytes or more are compressed on
+    a thread so they don't hold up the event loop.
+    """
+    types = ('application/json', 'application/x-ndjson', 'text/')
+
+    def __init__(self, settings: Settings):
+        config = settings['COMPRESSION']
+        levels = config.get('LEVELS', {})
+        enabled = config.get('ENCODINGS', [cls.name for cls in ENCODINGS])
+        self.min_size = config.get('MIN_SIZE', 1024)
+        self.offload_size = config.get('OFFLOAD_SIZE', 64 * 1024)
+        self.encodings = OrderedDict(
+            (cls.name, cls(levels.get(cls.name, cls.level)))
+            for cls in ENCODINGS
+            if cls.available and cls.name in enabled
+        )
+
+    def negotiate(self, accept_encoding):
+        """
+        Returns the name of the encoding to use for a request with the
+        `accept_encoding` header, or None.
+        """
+        if not accept_encoding or not self.encodings:
+            return None
+        weights = {}
+        for item in accept_encoding.split(','):
+            name, *params = item.split(';')
+            weight = 1.0
+            for param in params:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            weights[name.strip().lower()] = weight
+        default = weights.get('*', 0.0)
+        best, best_weight = None, 0.0
+        for name in self.encodings:
+            weight = weights.get(name, default)
+            if weight > best_weight:
+                best, best_weight = name, weight
+        return best
+
+    def compressible(self, message):
+        content_type = header(message.get('headers', []), b'content-type')
+        return (
+            message.get('status') != 204 and
+            content_type is not None and
+            content_type.startswith(self.types) and
+            header(message['headers'], b'content-encoding') is None
+        )
+
+    async def apply(self, message, encoding):
+        """
+        Returns the response `message` with its content compressed with
+        `encoding`, if it is worth it.
+
+        The ETag is weakened whenever an encoding is negotiated, compressed
+        or not, so that a 304 carries the same ETag and Vary as the 200 it
+        revalidates.
+        """
+        if not self.compressible(message):
+            return message
+        headers = message['headers'] + [[b'vary', b'Accept-Encoding']]
+        if encoding is not None:
+            headers = [
+                [key, b'W/' + value]
+                if key.lower() == b'etag' and value.startswith(b'"')
+                else [key, value]
+                for key, value in headers
+            ]
+        content = message.get('content', b'')
+        streamed = hasattr(content, '__aiter__')
+        if encoding is None or message.get('status') == 304 or (
+                not streamed and len(content) < self.min_size):
+            return dict(message, headers=headers)
+
+        headers += [[b'content-encoding', encoding.encode()]]
+        if streamed:
+            content = self.stream(encoding, content)
+        else:
+            content = await self.run(
+                self.encodings[encoding].compress, content)
+        return dict(message, headers=headers, content=content)
+
+    async def stream(self, encoding, chunks):
+        stream = self.encodings[encoding].stream()
+        async for chunk in chunks:
+            compressed = await self.run(stream.compress, chunk)
+            if compressed:
+                yield compressed
+        yield stream.finish()
+
+    async def run(self, func, data):
+        if len(data) < self.offload_size:
+            return func(data)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, data)
@@ -0,0 +1,35 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from apistar import Settings
+from apistar.backends.sqlalchemy_backend import SQLAlchemyBackend
+
+
+class PooledBackend(SQLAlchemyBackend):
+    """
+    A SQLAlchemy backend whose connection pool and default statement
+    timeout are configured from `settings['DATABASE']`.
+    """
+    def __init__(self, settings: Settings):
+        self.config = settings['DATABASE']
+        self.metadata = self.config['METADATA']
+        self.engine = self.create_engine(self.config['URL'])
+        self.Session = sessionmaker(bind=self.engine)
+
+    def create_engine(self, url):
+        config = self.config
+        kwargs = {
+            'pool_pre_ping': config.get('POOL_PRE_PING', False),
+            'pool_recycle': config.get('POOL_RECYCLE', -1),
+        }
+        if url.startswith('postgresql'):
+            kwargs.update({
+                'pool_size': config.get('POOL_SIZE', 5),
+                'max_overflow': config.get('MAX_OVERFLOW', 10),
+                'pool_timeout': config.get('POOL_TIMEOUT', 30),
+            })
+            if config.get('STATEMENT_TIMEOUT'):
+                kwargs['connect_args'] = {
+                    'options': '-c statement_timeout={:d}'.format(
+                        config['STATEMENT_TIMEOUT'])
+                }
+        return create_engine(url, **kwargs)
@@ -1,16 +1,112 @@
+from collections import OrderedDict
+from operator import attrgetter
 from apistar import typesystem
-from sqlalchemy import inspect
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import inspect, Index
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from instrumentation import timing
 
 
 class BaseScheme(typesystem.Object):
     render_fields = []
+    filter_fields = []
+    search_fields = []
+    sort_fields = []
+    include_fields = []
+    natural_key = []
+    count_mode = 'exact'
     properties = {}
 
 
+def converter(model, key, coerce):
+    """
+    Returns `coerce` if values read from `key` may need converting to the
+    scheme's type, or None when its column already yields that type.
+    """
+    column = model.__table__.c.get(key)
+    if coerce is None or column is None:
+        return coerce
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return coerce
+    return None if issubclass(coerce, python_type) else coerce
+
+
+class Serializer():
+    """
+    Renders instances or column rows of a model class by reading only the
+    scheme's `render_fields` (or a subset of them) with one getter, and
+    converting only the fields whose column type doesn't match the
+    scheme's, all computed once per class.
+    """
+    def __init__(self, model, fields=None):
+        scheme = model._scheme
+        self.keys = list(fields or scheme.render_fields)
+        if len(self.keys) == 1:
+            getter = attrgetter(self.keys[0])
+            self.values = lambda obj: (getter(obj),)
+        else:
+            self.values = attrgetter(*self.keys)
+        self.converters = [
+            (key, convert) for key, convert in (
+                (key, converter(model, key, scheme.properties.get(key)))
+                for key in self.keys
+            )
+            if convert is not None
+        ]
+
+    def __call__(self, obj):
+        row = dict(zip(self.keys, self.values(obj)))
+        for key, convert in self.converters:
+            value = row[key]
+            if not (value is None or isinstance(value, convert)):
+                row[key] = convert(value)
+        return row
+
+    def render_many(self, objs):
+        with timing('serialize'):
+            return [self(obj) for obj in objs]
+
+    def dumps(self, objs, encoder):
+        rows = self.render_many(objs)
+        with timing('serialize'):
+            return encoder.dumps(rows)
+
+    def dumps_lines(self, objs, encoder):
+        with timing('serialize'):
+            return encoder.dumps_lines(self(obj) for obj in objs)
+
+
+def index_name(table, field, kind=None):
+    return '_'.join(['ix', table, field] + ([kind] if kind else []))
+
+
 class IterableBase():
     _scheme = BaseScheme
 
+    @declared_attr
+    def __table_args__(cls):
+        """
+        B-tree indexes for the scheme's filterable and sortable fields,
+        other than the primary key, and a unique one for its natural key.
+        Trigram indexes for `search_fields` need the pg_trgm extension and
+        are added by migrations instead.
+        """
+        scheme = cls._scheme
+        key = scheme.natural_key
+        fields = OrderedDict.fromkeys(
+            scheme.filter_fields + scheme.sort_fields)
+        indexes = [
+            Index(index_name(cls.__tablename__, field), field)
+            for field in fields
+            if not cls.__dict__[field].primary_key and [field] != key
+        ]
+        if key:
+            indexes.append(Index(
+                index_name(cls.__tablename__, '_'.join(key)), *key,
+                unique=True))
+        return tuple(indexes)
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -18,9 +114,22 @@ class IterableBase():
         for c in inspect(self).mapper.column_attrs:
             yield (c.key, getattr(self, c.key))
 
+    @classmethod
+    def serializer(cls, fields=None):
+        if '_serializers' not in cls.__dict__:
+            cls._serializers = {}
+        key = tuple(fields or cls._scheme.render_fields)
+        if key not in cls._serializers:
+            cls._serializers[key] = Serializer(cls, key)
+        return cls._serializers[key]
+
+    @classmethod
+    def columns(cls, fields=None):
+        return [getattr(cls, key)
+                for key in fields or cls._scheme.render_fields]
+
     def render(self):
-        obj = self._scheme(dict(self))
-        return {k: obj[k] for k in self._scheme.render_fields}
+        return self.serializer()(self)
 
 
 Base = declarative_base(cls=IterableBase)
@@ -0,0 +1,85 @@
+import json
+import datetime
+import decimal
+from apistar import http, renderers, Settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def default(obj):
+    """
+    Encodes the values JSON has no type for: dates and times as ISO 8601
+    strings and decimals as strings, so they keep their precision.
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(
+            type(obj).__name__))
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(
+        obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def ujson_dumps(obj):
+    return ujson.dumps(
+        obj, default=default, ensure_ascii=False,
+        escape_forward_slashes=False).encode('utf-8')
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, default=default).encode('utf-8')
+
+
+ENCODERS = [
+    ('orjson', orjson is not None, orjson_dumps),
+    ('ujson', ujson is not None, ujson_dumps),
+    ('json', True, stdlib_dumps),
+]
+
+
+class Encoder():
+    """
+    Encodes response bodies to JSON bytes with the fastest installed
+    library among orjson, ujson and the standard library, or the one
+    named with `use`.
+    """
+    def __init__(self, name='auto'):
+        self.use(name)
+
+    def use(self, name):
+        available = [
+            (encoder, dumps) for encoder, installed, dumps in ENCODERS
+            if installed and name in ('auto', encoder)
+        ]
+        if not available:
+            raise ValueError('JSON encoder {} is not installed'.format(name))
+        self.name, self.dumps = available[0]
+
+    def dumps_lines(self, objs):
+        return b''.join(self.dumps(obj) + b'\n' for obj in objs)
+
+
+def get_encoder(settings: Settings):
+    """
+    The app's encoder, named by the `JSON_ENCODER` setting: `'orjson'`,
+    `'ujson'`, `'json'` or `'auto'` for the fastest one installed.
+    """
+    return Encoder(settings.get('JSON_ENCODER', 'auto'))
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    def render(self, data: http.ResponseData, encoder: Encoder) -> bytes:
+        return encoder.dumps(data)
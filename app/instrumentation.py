@@ -0,0 +1,186 @@
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from apistar import Settings
+
+
+logger = logging.getLogger()
+
+current_span = contextvars.ContextVar('span', default=None)
+local = threading.local()
+
+
+class Span():
+    """
+    Timings of one request: seconds spent in database work (which
+    includes `serialize` when rows are serialized on the pool's threads),
+    serialization and authentication, and the number of SQL statements.
+    """
+    __slots__ = ['route', 'method', 'start', 'db', 'serialize', 'auth',
+                 'queries']
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.serialize = 0.0
+        self.auth = 0.0
+        self.queries = 0
+
+
+def active_span():
+    """
+    Returns the span of the request being served, either on the event
+    loop or on a thread running its database work.
+    """
+    return getattr(local, 'span', None) or current_span.get()
+
+
+@contextmanager
+def tracking(span):
+    """
+    Makes `span` the active one on the current thread.
+    """
+    previous = getattr(local, 'span', None)
+    local.span = span
+    try:
+        yield
+    finally:
+        local.span = previous
+
+
+@contextmanager
+def timing(key):
+    """
+    Adds the time spent in the block to attribute `key` of the active
+    span, if there is one.
+    """
+    span = active_span()
+    if span is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(span, key, getattr(span, key) + time.perf_counter() - start)
+
+
+class Metrics():
+    """
+    Aggregates request spans by route, counts SQL statements and logs the
+    ones slower than `DATABASE['SLOW_QUERY_TIME']` milliseconds.
+
+    Every worker process keeps its own numbers.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, settings: Settings):
+        self.slow_query = settings['DATABASE'].get('SLOW_QUERY_TIME', 0)
+        self.requests = defaultdict(int)
+        self.durations = defaultdict(lambda: [0] * len(self.buckets))
+        self.duration_sums = defaultdict(float)
+        self.duration_counts = defaultdict(int)
+        self.db = defaultdict(float)
+        self.serialize = defaultdict(float)
+        self.auth = defaultdict(float)
+        self.queries = defaultdict(int)
+        self.slow_queries = 0
+        if not event.contains(
+                Engine, 'before_cursor_execute', self.before_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        span = active_span()
+        if span is not None:
+            span.queries += 1
+        if self.slow_query and elapsed * 1000 >= self.slow_query:
+            self.slow_queries += 1
+            logger.warning('Slow query ({:d}ms): {}'.format(
+                int(elapsed * 1000), ' '.join(statement.split())))
+
+    def observe(self, span, status):
+        duration = time.perf_counter() - span.start
+        route = span.route
+        self.requests[(route, span.method, status)] += 1
+        for index, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.durations[route][index] += 1
+                break
+        self.duration_sums[route] += duration
+        self.duration_counts[route] += 1
+        self.db[route] += max(0.0, span.db - span.serialize)
+        self.serialize[route] += span.serialize
+        self.auth[route] += span.auth
+        self.queries[route] += span.queries
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, format_labels(labels), value))
+
+        family('http_requests_total', 'counter', 'Requests served.', [
+            ('', {'route': route, 'method': method, 'status': status}, value)
+            for (route, method, status), value in sorted(
+                self.requests.items(), key=str)
+        ])
+        samples = []
+        for route in sorted(self.duration_counts):
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.durations[route]):
+                cumulative += count
+                samples.append(
+                    ('_bucket', {'route': route, 'le': bound}, cumulative))
+            samples.append(('_bucket', {'route': route, 'le': '+Inf'},
+                            self.duration_counts[route]))
+            samples.append(
+                ('_sum', {'route': route}, self.duration_sums[route]))
+            samples.append(
+                ('_count', {'route': route}, self.duration_counts[route]))
+        family('http_request_duration_seconds', 'histogram',
+               'Time to serve requests.', samples)
+        for name, values, help in [
+            ('http_request_db_seconds_total', self.db,
+             'Time spent in database work.'),
+            ('http_request_serialize_seconds_total', self.serialize,
+             'Time spent serializing rows.'),
+            ('http_request_auth_seconds_total', self.auth,
+             'Time spent authenticating.'),
+            ('http_request_db_queries_total', self.queries,
+             'SQL statements executed.'),
+        ]:
+            family(name, 'counter', help, [
+                ('', {'route': route}, value)
+                for route, value in sorted(values.items())
+            ])
+        family('db_slow_queries_total', 'counter',
+               'SQL statements slower than the slow query time.',
+               [('', {}, self.slow_queries)])
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+        for key, value in labels.items()
+    ))
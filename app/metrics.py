@@ -0,0 +1,62 @@
+from apistar import annotate, http, Settings
+from async_session import SessionPool, WriteBatcher
+from cache import Cache
+from instrumentation import Metrics, format_labels
+from tokens.routes import TokenAuthentication
+from users.passwords import PasswordHasher
+
+
+def gauges(name, help, values):
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name)]
+    for labels, value in values:
+        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    return lines
+
+
+def metrics(
+    registry: Metrics,
+    pool: SessionPool,
+    batcher: WriteBatcher,
+    cache: Cache,
+    hasher: PasswordHasher,
+    settings: Settings
+):
+    lines = registry.render()
+    lines += gauges('db_pool', 'Connection pool and checkout statistics.', [
+        ({'stat': key}, value) for key, value in sorted(pool.stats().items())
+    ])
+    lines += gauges('write_batches', 'Batched write statistics.', [
+        ({'stat': 'batches'}, batcher.batches),
+        ({'stat': 'writes'}, batcher.writes),
+    ])
+    lines += gauges('response_cache', 'Response cache statistics.', [
+        ({'stat': key}, value) for key, value in sorted(cache.stats().items())
+    ])
+    lines += gauges('token_cache', 'Verified token cache statistics.', [
+        ({'stat': key}, getattr(authentication, key))
+        for authentication in settings['AUTHENTICATION']
+        if isinstance(authentication, TokenAuthentication)
+        for key in ['hits', 'misses']
+    ])
+    lines += gauges(
+        'password_hasher_pending', 'Password hashes and checks in flight.',
+        [({}, hasher.pending)])
+    return http.Response(
+        ('\n'.join(lines) + '\n').encode('utf-8'),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@annotate(permissions=[])
+def public_metrics(
+    registry: Metrics,
+    pool: SessionPool,
+    batcher: WriteBatcher,
+    cache: Cache,
+    hasher: PasswordHasher,
+    settings: Settings
+):
+    """
+    `metrics` without authentication, served when METRICS['PUBLIC'] is
+    set, e.g. for a scraper on a private network.
+    """
+    return metrics(registry, pool, batcher, cache, hasher, settings)
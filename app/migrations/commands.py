@@ -1,6 +1,11 @@
 import os
+import re
+from collections import OrderedDict
 from alembic import command
 from alembic.config import Config
+from sqlalchemy import inspect
+from apistar.backends.sqlalchemy_backend import SQLAlchemyBackend
+from rest_utils import SLOW_FILTER_RE
 
 
 class MigrationsConfig(Config):
@@ -22,3 +27,58 @@ def upgrade():
 
 def downgrade():
     command.downgrade(config, '-1')
+
+
+def indexed_columns(backend, table):
+    """
+    Returns the leading columns of the B-tree and of the GIN indexes
+    on `table`, including its primary key.
+    """
+    inspector = inspect(backend.engine)
+    btree = set(inspector.get_pk_constraint(table)['constrained_columns'][:1])
+    gin = set()
+    for index in inspector.get_indexes(table):
+        using = index.get('dialect_options', {}).get('postgresql_using')
+        (gin if using == 'gin' else btree).add(index['column_names'][0])
+    return btree, gin
+
+
+def is_indexed(term, btree, gin):
+    field, op = re.match(r'(\w+)(.*)', term).groups()
+    return field in (gin if op == '~contains~' else btree)
+
+
+def report_slow_filters(log: str, backend: SQLAlchemyBackend):
+    """
+    Report slow filter patterns found in a server log that aren't
+    backed by an index, slowest in total first.
+
+    Args:
+      log: Path to the log to read.
+      backend: The configured database backend.
+    """
+    patterns = OrderedDict()
+    with open(log) as lines:
+        for line in lines:
+            match = SLOW_FILTER_RE.search(line.rstrip('\n'))
+            if match:
+                key = match.group('table', 'pattern')
+                patterns.setdefault(key, []).append(int(match.group('time')))
+
+    indexes = {}
+    report = []
+    for (table, pattern), times in patterns.items():
+        if table not in indexes:
+            indexes[table] = indexed_columns(backend, table)
+        unindexed = [
+            term for term in pattern.split()
+            if not is_indexed(term, *indexes[table])
+        ]
+        if unindexed:
+            report.append((sum(times), (
+                '{} {}: {} hits, avg {}ms, max {}ms, unindexed {}'.format(
+                    table, pattern, len(times), sum(times) // len(times),
+                    max(times), ' '.join(unindexed)))))
+
+    report.sort(key=lambda item: -item[0])
+    return '\n'.join(line for total, line in report) or 'No slow filters.'
@@ -1,7 +1,9 @@
 from alembic import context
-from sqlalchemy import engine_from_config, pool
+from alembic.operations import ops
+from sqlalchemy import engine_from_config, pool, inspect
 import logging
 from app import settings, Base
+from db_base import index_name
 
 
 logger = logging.getLogger()
@@ -11,6 +13,41 @@ config.set_main_option('sqlalchemy.url', settings['DATABASE']['URL'])
 target_metadata = Base.metadata
 
 
+def trigram_ops(connection):
+    """
+    Returns the operations creating and dropping the trigram indexes that
+    models' `search_fields` ask for and the database doesn't have yet.
+    They're kept out of the metadata because they need pg_trgm.
+    """
+    inspector = inspect(connection)
+    tables = inspector.get_table_names()
+    upgrade, downgrade = [], []
+    for model in Base._decl_class_registry.values():
+        table = getattr(model, '__tablename__', None)
+        if table is None:
+            continue
+        existing = {
+            index['name'] for index in inspector.get_indexes(table)
+        } if table in tables else set()
+        for field in model._scheme.search_fields:
+            name = index_name(table, field, 'trgm')
+            if name in existing:
+                continue
+            upgrade.append(ops.CreateIndexOp(
+                name, table, [field], postgresql_using='gin',
+                postgresql_ops={field: 'gin_trgm_ops'}))
+            downgrade.insert(0, ops.DropIndexOp(name, table_name=table))
+    if upgrade:
+        upgrade.insert(
+            0, ops.ExecuteSQLOp('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    return upgrade, downgrade
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ == 'index' and reflected and compare_to is None and
+                name.endswith('_trgm'))
+
+
 def run_migrations_offline():
     url = config.get_main_option("sqlalchemy.url")
     context.configure(url=url)
@@ -21,8 +58,11 @@ def run_migrations_offline():
 
 def run_migrations_online():
     def process_revision_directives(context, revision, directives):
+        script = directives[0]
+        upgrade, downgrade = trigram_ops(context.connection)
+        script.upgrade_ops.ops.extend(upgrade)
+        script.downgrade_ops.ops[:0] = downgrade
         if getattr(config.cmd_opts, 'autogenerate', False):
-            script = directives[0]
             if script.upgrade_ops.is_empty():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
@@ -34,6 +74,7 @@ def run_migrations_online():
     connection = engine.connect()
     context.configure(connection=connection,
                       target_metadata=target_metadata,
+                      include_object=include_object,
                       process_revision_directives=process_revision_directives)
 
     try:
@@ -13,6 +13,10 @@ class NullableInt(typesystem.Integer):
 
 class ProjectScheme(BaseScheme):
     render_fields = ['id', 'name', 'user_id']
+    filter_fields = ['id', 'name', 'user_id']
+    search_fields = ['name']
+    sort_fields = ['id', 'name']
+    include_fields = ['user']
     properties = {
         "id": typesystem.integer(default=0),
         "name": typesystem.String,
@@ -1,12 +1,86 @@
 import re
-from sqlalchemy import or_
-from apistar import http, Route
-from apistar.backends.sqlalchemy_backend import Session
-from apistar.exceptions import NotFound, BadRequest
+import json
+import time
+import logging
+import base64
+import hashlib
+import functools
+import binascii
+import decimal
+from itertools import islice
+from collections import OrderedDict, namedtuple
+from sqlalchemy import (
+    or_, and_, tuple_, inspect, select, literal_column, String, Boolean
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.sql import functions
+from apistar import http, Route, Settings
+from apistar.interfaces import Auth
+from apistar.exceptions import (
+    HTTPException, NotFound, BadRequest, TypeSystemError
+)
 from apistar import typesystem
+from async_session import AsyncSession
+from cache import Cache
+from encoders import Encoder
+from users.passwords import PasswordHasher
 
 
-class Filters(typesystem.String):
+logger = logging.getLogger()
+
+Filter = namedtuple('Filter', ['condition', 'pattern'])
+
+SLOW_FILTER_FORMAT = 'Slow filter on {table} ({time:d}ms): {pattern}'
+SLOW_FILTER_RE = re.compile(
+    r'Slow filter on (?P<table>\w+) \((?P<time>\d+)ms\): (?P<pattern>.*)$')
+
+
+def model_columns(model, fields):
+    """
+    Returns the mapped column attributes of `model` among `fields`, which
+    leaves out relationships.
+    """
+    return OrderedDict(
+        (field, getattr(model, field))
+        for field in fields if field in model.__table__.c
+    )
+
+
+def coerce(column, value):
+    """
+    Converts a filter `value` to the type of `column` when it is numeric
+    or boolean, so a value the column can't hold is a BadRequest instead
+    of a database error. Other values are left for the database to cast.
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    try:
+        if issubclass(python_type, bool):
+            return {'true': True, 'false': False}[value.lower()]
+        if issubclass(python_type, (int, float, decimal.Decimal)):
+            return python_type(value)
+    except (KeyError, ValueError, decimal.InvalidOperation):
+        raise BadRequest()
+    return value
+
+
+class FilterCompiler():
+    """
+    Compiles `filters` strings of one model into a single SQL condition
+    and remembers the last `size` distinct strings.
+
+    Terms look like `field<operator>value` and may only name the scheme's
+    `filter_fields`, or its `search_fields` for `~contains~`. `;` joins
+    terms with AND, `,` with OR (AND binds tighter) and parentheses group
+    them, e.g. `(name==a,name==b);user_id==1`. A backslash makes the next
+    character of a value literal, e.g. `name==a\\;b`.
+
+    Besides the condition, each result carries the pattern of fields and
+    operators used, which is what slow queries are logged under.
+    """
     operator_map = {
         '==': '__eq__',
         '!=': '__ne__',
@@ -16,99 +90,932 @@ class Filters(typesystem.String):
         '<=': '__le__',
         '~contains~': 'contains',
     }
-    description = (
-        "comparison operators: {}".format(" , ".join(operator_map.keys()))
+    token = re.compile(
+        r'\s*(?:(?P<punct>[();,])|'
+        r'(?P<field>\w+)(?P<op>==|!=|>=|<=|>|<|~\w+~)'
+        r'(?P<value>(?:[^();,\\]|\\.)*))'
     )
+    escape = re.compile(r'\\(.)')
+    max_depth = 16
 
-    def __new__(cls, *args, **kwargs):
-        data = super().__new__(cls, *args, **kwargs)
+    def __init__(self, model, size=256):
+        scheme = model._scheme
+        self.columns = model_columns(model, scheme.filter_fields)
+        self.searchable = model_columns(model, scheme.search_fields)
+        self.compile = functools.lru_cache(size)(self.parse)
 
-        pairs = data.split(',')
-        expressions = []
+    def parse(self, data):
+        tokens = self.tokenize(data.strip())
+        condition, pos = self.any_of(tokens, 0, 0)
+        if pos != len(tokens):
+            raise BadRequest()
+        pattern = ' '.join(sorted(set(
+            field + op for kind, field, op, clause in tokens
+            if kind == 'term'
+        )))
+        return Filter(condition, pattern)
 
-        for pair in pairs:
-            # finds comparison operators or anything between `~`
-            op = re.search(r'(>(=)?)|(<(=)?)|(==)|(!=)|~(.*)~', pair)
-            try:
-                operator = cls.operator_map.get(op.group())
-                field_name, value = pair.split(op.group())
-                column = getattr(cls.model, field_name)
-                comparator = getattr(column, operator)
-                expressions.append(comparator(value))
-            except AttributeError:
+    def tokenize(self, data):
+        tokens, pos = [], 0
+        while pos < len(data):
+            match = self.token.match(data, pos)
+            if not match:
                 raise BadRequest()
-        return expressions
+            if match.group('punct'):
+                tokens.append((match.group('punct'), None, None, None))
+            else:
+                field, op, value = match.group('field', 'op', 'value')
+                clause = self.term(field, op, value)
+                tokens.append(('term', field, op, clause))
+            pos = match.end()
+        return tokens
+
+    def term(self, field, op, value):
+        operator = self.operator_map.get(op)
+        columns = self.searchable if operator == 'contains' else self.columns
+        column = columns.get(field)
+        if column is None or operator is None:
+            raise BadRequest()
+        if operator == 'contains' and not isinstance(column.type, String):
+            raise BadRequest()
+        value = coerce(column, self.escape.sub(r'\1', value))
+        return getattr(column, operator)(value)
+
+    def any_of(self, tokens, pos, depth):
+        return self.join(tokens, pos, depth, ',', or_, self.all_of)
+
+    def all_of(self, tokens, pos, depth):
+        return self.join(tokens, pos, depth, ';', and_, self.atom)
+
+    def join(self, tokens, pos, depth, separator, conjunction, operand):
+        clauses = []
+        while True:
+            clause, pos = operand(tokens, pos, depth)
+            clauses.append(clause)
+            if pos < len(tokens) and tokens[pos][0] == separator:
+                pos += 1
+            else:
+                break
+        if len(clauses) == 1:
+            return clauses[0], pos
+        return conjunction(*clauses), pos
+
+    def atom(self, tokens, pos, depth):
+        if pos >= len(tokens):
+            raise BadRequest()
+        kind, field, op, clause = tokens[pos]
+        if kind == 'term':
+            return clause, pos + 1
+        if kind != '(' or depth >= self.max_depth:
+            raise BadRequest()
+        clause, pos = self.any_of(tokens, pos + 1, depth + 1)
+        if pos >= len(tokens) or tokens[pos][0] != ')':
+            raise BadRequest()
+        return clause, pos + 1
+
+
+class Filters(typesystem.String):
+    description = (
+        "comparison operators: {} ; join terms with `;` for AND, `,` for OR "
+        "and group them with parentheses; escape `(`, `)`, `;`, `,` and `\\` "
+        "in values with `\\`".format(
+            " , ".join(FilterCompiler.operator_map.keys()))
+    )
+    compilers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        model = getattr(cls, 'model', None)
+        if model is not None:
+            if model not in cls.compilers:
+                cls.compilers[model] = FilterCompiler(model)
+            cls.compiler = cls.compilers[model]
+
+    def __new__(cls, *args, **kwargs):
+        data = super().__new__(cls, *args, **kwargs)
+        return cls.compiler.compile(str(data))
 
 
 class Ordering(typesystem.String):
     description = "prepend field name with `-` to descend"
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if getattr(cls, 'model', None) is not None:
+            cls.expressions = {}
+            for name, column in model_columns(
+                cls.model, cls.model._scheme.sort_fields
+            ).items():
+                cls.expressions[name] = column.asc
+                cls.expressions['-' + name] = column.desc
+
+    def __new__(cls, *args, **kwargs):
+        data = super().__new__(cls, *args, **kwargs)
+
+        try:
+            return cls.expressions[str(data)]
+        except KeyError:
+            raise BadRequest()
+
+
+class Cursor(typesystem.String):
+    description = (
+        "pass an empty value for the first page, "
+        "then the value of the `X-Next-Cursor` header"
+    )
+
+    def __new__(cls, *args, **kwargs):
+        data = super().__new__(cls, *args, **kwargs)
+
+        if not data:
+            return []
+        try:
+            values = json.loads(base64.urlsafe_b64decode(data).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise BadRequest()
+        if not isinstance(values, list) or not all(
+                value is None or isinstance(value, (str, int, float))
+                for value in values):
+            raise BadRequest()
+        return values
+
+
+class Count(typesystem.Enum):
+    enum = ['exact', 'estimate', 'window', 'none']
+    description = (
+        "how to compute `X-Total-Count`: {}".format(" , ".join(enum))
+    )
+
+
+def estimate_count(session, qs):
+    """
+    Returns the planner's row estimate for `qs`, which costs a single
+    EXPLAIN instead of a full scan.
+    """
+    statement = qs.statement.compile(dialect=session.bind.dialect)
+    plan = session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(statement),
+        statement.params
+    ).scalar()
+    return plan[0]['Plan']['Plan Rows']
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=str).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def matches(column, value):
+    """
+    Whether a cursor `value` can be compared with `column`: the id must be
+    an integer, numbers go with numeric columns and strings with string
+    columns.
+    """
+    if value is None:
+        return not column.primary_key
+    if isinstance(value, bool):
+        return False
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return True
+    if column.primary_key or issubclass(python_type, int):
+        return isinstance(value, int)
+    if issubclass(python_type, (float, decimal.Decimal)):
+        return isinstance(value, (int, float))
+    if issubclass(python_type, str):
+        return isinstance(value, str)
+    return True
+
+
+def keyset(model, ordering, cursor):
+    """
+    Returns the columns to order by and the condition selecting rows after
+    `cursor`. NULLs come last ascending and first descending, as Postgres
+    sorts them.
+    """
+    if ordering:
+        column, descending = ordering.__self__, ordering.__name__ == 'desc'
+    else:
+        column, descending = model.id, False
+    columns = [model.id] if column is model.id else [column, model.id]
+    order_by = [c.desc() if descending else c.asc() for c in columns]
+
+    if not cursor:
+        return columns, order_by, None
+    if len(cursor) != len(columns) or not all(
+            matches(column, value) for column, value in zip(columns, cursor)):
+        raise BadRequest()
+
+    if len(columns) == 1:
+        last_id, = cursor
+        after = model.id < last_id if descending else model.id > last_id
+    else:
+        value, last_id = cursor
+        row, last = tuple_(column, model.id), tuple_(value, last_id)
+        if descending and value is None:
+            after = or_(
+                column.isnot(None),
+                and_(column.is_(None), model.id < last_id)
+            )
+        elif descending:
+            after = row < last
+        elif value is None:
+            after = and_(column.is_(None), model.id > last_id)
+        else:
+            after = or_(row > last, column.is_(None))
+    return columns, order_by, after
+
+
+class Fields(typesystem.String):
+    description = "comma separated subset of the rendered fields"
+
+    def __new__(cls, *args, **kwargs):
+        data = super().__new__(cls, *args, **kwargs)
+
+        requested = set(data.split(','))
+        render_fields = cls.model._scheme.render_fields
+        if not requested <= set(render_fields):
+            raise BadRequest()
+        return [field for field in render_fields if field in requested]
+
+
+class Includes(typesystem.String):
+    description = "comma separated relationships to embed"
+
     def __new__(cls, *args, **kwargs):
         data = super().__new__(cls, *args, **kwargs)
 
-        expression = None
-        order = "desc" if data.startswith('-') else "asc"
+        requested = list(OrderedDict.fromkeys(data.split(',')))
+        if not set(requested) <= set(cls.model._scheme.include_fields):
+            raise BadRequest()
+        return requested
+
+
+class GroupBy(typesystem.String):
+    description = "comma separated filter fields to group by"
+
+    def __new__(cls, *args, **kwargs):
+        data = super().__new__(cls, *args, **kwargs)
+
+        requested = list(OrderedDict.fromkeys(data.split(',')))
+        columns = model_columns(cls.model, cls.model._scheme.filter_fields)
+        if not set(requested) <= set(columns):
+            raise BadRequest()
+        return [columns[field] for field in requested]
+
+
+class Aggregates(typesystem.String):
+    description = (
+        "comma separated `count`, `min:<field>` or `max:<field>` "
+        "over filter fields"
+    )
+    functions = {'min': functions.min, 'max': functions.max}
+
+    def __new__(cls, *args, **kwargs):
+        data = super().__new__(cls, *args, **kwargs)
+
+        columns = model_columns(cls.model, cls.model._scheme.filter_fields)
+        aggregates = OrderedDict()
+        for metric in data.split(','):
+            if metric == 'count':
+                aggregates[metric] = functions.count()
+                continue
+            name, _, field = metric.partition(':')
+            if name not in cls.functions or field not in columns:
+                raise BadRequest()
+            aggregates['{}_{}'.format(name, field)] = \
+                cls.functions[name](columns[field])
+        return aggregates
+
+
+def relation(model, name):
+    """
+    Returns the relationship `name` of `model` with the attributes joining
+    it on the parent side and on the child side.
+    """
+    relationship = inspect(model).relationships[name]
+    (local, remote), = relationship.local_remote_pairs
+    return (
+        relationship,
+        getattr(model, local.key),
+        getattr(relationship.mapper.class_, remote.key)
+    )
+
+
+def join_columns(model, includes, columns):
+    """
+    Returns the parent-side join columns of `includes` missing from
+    `columns`, which embedding needs in every row.
+    """
+    keys = {column.key for column in columns}
+    extra = OrderedDict()
+    for name in includes:
+        local = relation(model, name)[1]
+        if local.key not in keys:
+            extra[local.key] = local
+    return list(extra.values())
+
+
+def embed(session, model, includes, rows, rendered):
+    """
+    Adds the `includes` relationships of `rows` to their `rendered` dicts,
+    rendered with the child model's `render_fields`. Like `selectinload`,
+    it costs one query per relationship however many rows there are.
+    """
+    for name in includes:
+        relationship, local, remote = relation(model, name)
+        child = relationship.mapper.class_
+        keys = {getattr(row, local.key) for row in rows} - {None}
+        children = {}
+        if keys:
+            columns = child.columns()
+            if remote.key not in child._scheme.render_fields:
+                columns.append(remote)
+            serializer = child.serializer()
+            qs = session.query(*columns).filter(
+                remote.in_(keys)).order_by(child.id)
+            for row in qs:
+                children.setdefault(
+                    getattr(row, remote.key), []).append(serializer(row))
+        for row, item in zip(rows, rendered):
+            found = children.get(getattr(row, local.key), [])
+            if relationship.uselist:
+                item[name] = found
+            else:
+                item[name] = found[0] if found else None
+    return rendered
+
 
+def parse_rows(model, body, content_type):
+    """
+    Parses a JSON array or an NDJSON body and validates every item
+    against the model's scheme. Returns the number of items, the valid
+    rows as `(position, values)` pairs and the errors by position.
+    """
+    if content_type and content_type.startswith('application/x-ndjson'):
+        items = []
+        for line in body.decode().splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ValueError)
+    else:
         try:
-            field_name = re.sub(r'^-', '', data)
-            column = getattr(cls.model, field_name)
-            expression = getattr(column, order)
-        except AttributeError:
+            items = json.loads(body.decode())
+        except ValueError:
+            raise BadRequest()
+        if not isinstance(items, list):
             raise BadRequest()
-        return expression
+
+    rows, errors = [], {}
+    for index, item in enumerate(items):
+        if item is ValueError:
+            errors[index] = 'Invalid JSON.'
+            continue
+        if not isinstance(item, dict):
+            errors[index] = 'Must be an object.'
+            continue
+        try:
+            values = model._scheme(item)
+        except TypeSystemError as exc:
+            errors[index] = exc.detail
+            continue
+        values.pop('id', None)
+        rows.append((index, dict(values)))
+    return len(items), rows, errors
+
+
+def has_natural_key(model, values):
+    return all(
+        values.get(field) is not None
+        for field in model._scheme.natural_key
+    )
+
+
+def insert_statement(model, rows, upsert=False):
+    """
+    Returns a multi-row INSERT of `rows`. With `upsert`, rows conflicting
+    on the model's natural key update the existing row instead, with
+    `INSERT ... ON CONFLICT DO UPDATE`.
+    """
+    if not upsert:
+        return model.__table__.insert().values(rows)
+    key = model._scheme.natural_key
+    statement = postgresql.insert(model.__table__).values(rows)
+    updated = [field for field in rows[0] if field not in key] or key
+    return statement.on_conflict_do_update(
+        index_elements=key,
+        set_={field: statement.excluded[field] for field in updated})
+
+
+def insert_rows(session, model, rows, upsert=False):
+    """
+    Inserts rows with one multi-row INSERT ... RETURNING per distinct set
+    of keys, and returns the new ids by position.
+    """
+    table = model.__table__
+    groups = OrderedDict()
+    for index, values in rows:
+        groups.setdefault(tuple(sorted(values)), []).append((index, values))
+
+    created = {}
+    for group in groups.values():
+        result = session.execute(
+            insert_statement(
+                model, [values for _, values in group], upsert
+            ).returning(table.c.id)
+        )
+        created.update(zip([index for index, _ in group],
+                           [row[0] for row in result]))
+    return created
+
+
+def bulk_insert(session, model, rows, batch_size=1000, upsert=False):
+    """
+    Inserts rows in batches, each inside a savepoint. A batch that fails
+    is retried row by row, so a bad row only costs its own insert.
+    """
+    created, errors = {}, {}
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        try:
+            with session.begin_nested():
+                created.update(insert_rows(session, model, batch, upsert))
+            continue
+        except DBAPIError:
+            pass
+        for row in batch:
+            try:
+                with session.begin_nested():
+                    created.update(
+                        insert_rows(session, model, [row], upsert))
+            except DBAPIError:
+                errors[row[0]] = 'Could not be inserted.'
+    return created, errors
+
+
+def bulk_upsert(session, model, rows):
+    """
+    Upserts rows like `bulk_insert`, leaving out those lacking a value for
+    any field of the natural key, which can't conflict with a row.
+    """
+    errors = {}
+    for index, values in rows:
+        if not has_natural_key(model, values):
+            errors[index] = 'Missing natural key.'
+    created, failed = bulk_insert(
+        session, model, [row for row in rows if row[0] not in errors],
+        upsert=True)
+    errors.update(failed)
+    return created, errors
+
+
+def bulk_response(count, created, errors):
+    return http.Response(
+        {
+            'ids': [created.get(index) for index in range(count)],
+            'errors': errors,
+        },
+        status=207 if errors else 201
+    )
 
 
 def bind(cls, model):
-    cls.model = model
-    return cls
+    return type(cls.__name__, (cls,), {'model': model})
+
+
+def etag(content):
+    return '"{}"'.format(hashlib.sha1(content).hexdigest())
+
+
+def json_response(content, if_none_match=None, headers={}, status=200):
+    """
+    Returns already encoded JSON `content` with an ETag, or an empty 304
+    when `if_none_match` names that ETag.
+    """
+    tag = etag(content)
+    headers = dict(headers, ETag=tag)
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        if '*' in tags or tag in tags or 'W/' + tag in tags:
+            return http.Response(
+                b'', status=304, headers=headers,
+                content_type='application/json')
+    return http.Response(
+        content, status=status, headers=headers,
+        content_type='application/json')
+
+
+STREAM_BATCH_SIZE = 1000
+
+
+async def prefetch(chunks):
+    """
+    Waits for the first of the async iterator `chunks`, so that errors
+    raised before anything is produced surface before the response
+    headers are sent, and returns an async iterator over all of them.
+    """
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        return b''
+
+    async def content():
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    return content()
 
 
 def list_route(model):
     async def func(
-        session: Session,
+        session: AsyncSession,
         filters: bind(Filters, model),
         ordering: bind(Ordering, model),
+        fields: bind(Fields, model),
+        include: bind(Includes, model),
+        cursor: Cursor,
+        count: Count,
+        stream: typesystem.Boolean,
         limit: int,
         offset: int,
-        query_params: http.QueryParams
+        accept: http.Header,
+        if_none_match: http.Header,
+        query_params: http.QueryParams,
+        settings: Settings,
+        encoder: Encoder
     ):
-        qs = session.query(model)
-        if filters:
-            qs = qs.filter(or_(*filters))
-        if ordering:
-            qs = qs.order_by(ordering())
-        count = qs.count()
-        if limit:
-            qs = qs.limit(limit)
-        if offset:
-            qs = qs.offset(offset)
-        return http.Response(
-            [obj.render() for obj in qs],
-            headers={"X-Total-Count": str(count)}
-        )
+        mode = count or model._scheme.count_mode
+        slow = settings['DATABASE'].get('SLOW_FILTER_TIME', 0)
+        fields = fields or model._scheme.render_fields
+        include = include or []
+        serializer = model.serializer(fields)
+        columns = model.columns(fields)
+        columns += join_columns(model, include, columns)
+
+        def render(session, rows):
+            rows = list(rows)
+            return embed(
+                session, model, include, rows, serializer.render_many(rows))
+
+        def dumps(session, rows):
+            if not include:
+                return serializer.dumps(rows, encoder)
+            return encoder.dumps(render(session, rows))
+
+        def dumps_lines(session, rows):
+            if not include:
+                return serializer.dumps_lines(rows, encoder)
+            return encoder.dumps_lines(render(session, rows))
+
+        def select(qs):
+            start = time.monotonic()
+            rows = qs.all()
+            elapsed = (time.monotonic() - start) * 1000
+            if filters is not None and slow and elapsed >= slow:
+                logger.warning(SLOW_FILTER_FORMAT.format(
+                    table=model.__tablename__, time=int(elapsed),
+                    pattern=filters.pattern))
+            return rows
+
+        def query(session):
+            qs = session.query(*columns)
+            if filters is not None:
+                qs = qs.filter(filters.condition)
+            total = None
+            if mode == 'exact' or (mode == 'window' and cursor is not None):
+                total = qs.count()
+            elif mode == 'estimate':
+                total = estimate_count(session, qs)
+            if cursor is not None:
+                return (total,) + paginate(session, qs)
+
+            filtered = qs
+            if ordering:
+                qs = qs.order_by(ordering())
+            if limit:
+                qs = qs.limit(limit)
+            if offset:
+                qs = qs.offset(offset)
+            if mode != 'window':
+                return total, dumps(session, select(qs)), None
+
+            rows = select(qs.add_columns(functions.count().over()))
+            if rows:
+                total = rows[0][-1]
+            else:
+                total = filtered.count() if offset else 0
+            return total, dumps(session, rows), None
+
+        def paginate(session, qs):
+            keys, order_by, after = keyset(model, ordering, cursor)
+            selected = {c.key for c in columns}
+            qs = qs.add_columns(*[c for c in keys if c.key not in selected])
+            if after is not None:
+                qs = qs.filter(after)
+            qs = qs.order_by(*order_by)
+            if limit:
+                qs = qs.limit(limit + 1)
+            rows = select(qs)
+            next_cursor = None
+            if limit and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(
+                    [getattr(rows[-1], c.key) for c in keys])
+            return dumps(session, rows), next_cursor
+
+        def lines(session):
+            qs = session.query(*columns)
+            if filters is not None:
+                qs = qs.filter(filters.condition)
+            if ordering:
+                qs = qs.order_by(ordering())
+            if limit:
+                qs = qs.limit(limit)
+            if offset:
+                qs = qs.offset(offset)
+            rows = iter(qs.yield_per(STREAM_BATCH_SIZE))
+            batch = list(islice(rows, STREAM_BATCH_SIZE))
+            while batch:
+                yield dumps_lines(session, batch)
+                batch = list(islice(rows, STREAM_BATCH_SIZE))
+
+        if stream or 'application/x-ndjson' in (accept or ''):
+            if cursor is not None:
+                raise BadRequest()
+            content = await prefetch(session.stream(lines))
+            return http.Response(
+                content, content_type='application/x-ndjson')
+
+        total, content, next_cursor = await session.run(query)
+        headers = {}
+        if total is not None:
+            headers["X-Total-Count"] = str(total)
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        return json_response(content, if_none_match, headers)
     return Route(
         '/', 'GET', func, name="list_{}s".format(model.__name__.lower()))
 
 
+def aggregate_route(model):
+    async def func(
+        session: AsyncSession,
+        filters: bind(Filters, model),
+        group_by: bind(GroupBy, model),
+        metric: bind(Aggregates, model),
+        limit: int,
+        if_none_match: http.Header,
+        encoder: Encoder
+    ):
+        group_by = group_by or []
+        metric = metric or OrderedDict(count=functions.count())
+        keys = [column.key for column in group_by] + list(metric)
+
+        def aggregate(session):
+            qs = session.query(*group_by + [
+                expression.label(name) for name, expression in metric.items()
+            ])
+            if filters is not None:
+                qs = qs.filter(filters.condition)
+            if group_by:
+                qs = qs.group_by(*group_by).order_by(*group_by)
+            if limit:
+                qs = qs.limit(limit)
+            return [OrderedDict(zip(keys, row)) for row in qs]
+
+        rows = await session.run(aggregate)
+        return json_response(encoder.dumps(rows), if_none_match)
+    return Route(
+        '/aggregate', 'GET', func,
+        name="aggregate_{}s".format(model.__name__.lower()))
+
+
+def cache_key(model, id):
+    return (model.__tablename__, id)
+
+
+def invalidate(cache, model, ids):
+    for id in ids:
+        cache.delete(cache_key(model, id))
+
+
+UNIQUE_VIOLATION = '23505'
+
+
+class Conflict(HTTPException):
+    default_status_code = 409
+    default_detail = 'Conflicts with an existing row'
+
+
+def execute_write(session, statement):
+    """
+    Executes a write and returns its first row, turning unique violations
+    such as a duplicate natural key into a 409 and other constraint
+    violations, such as a missing foreign row, into a 400.
+    """
+    try:
+        return session.execute(statement).first()
+    except IntegrityError as exc:
+        if getattr(exc.orig, 'pgcode', None) == UNIQUE_VIOLATION:
+            raise Conflict()
+        raise BadRequest('Violates a constraint')
+
+
+def returning(model):
+    return [model.__table__.c[field] for field in model._scheme.render_fields]
+
+
+def create_row(session, model, data):
+    """
+    Inserts a row and renders it from `INSERT ... RETURNING`, in a single
+    round trip.
+    """
+    data.pop('id', None)
+    row = execute_write(
+        session,
+        model.__table__.insert().values(**data).returning(*returning(model)))
+    return model.serializer()(row)
+
+
+def update_row(session, model, id, data):
+    """
+    Updates a row and renders it from `UPDATE ... RETURNING`, in a single
+    round trip. An empty update only selects the row.
+    """
+    table = model.__table__
+    data = dict(data or {})
+    data.pop('id', None)
+    if data:
+        statement = table.update().where(
+            table.c.id == id
+        ).values(**data).returning(*returning(model))
+    else:
+        statement = select(returning(model)).where(table.c.id == id)
+    row = execute_write(session, statement)
+    if not row:
+        raise NotFound()
+    return model.serializer()(row)
+
+
+def upsert_row(session, model, data):
+    """
+    Inserts a row or updates the one with the same natural key, in a
+    single round trip. Returns the rendered row and whether it is new.
+    """
+    data.pop('id', None)
+    if not has_natural_key(model, data):
+        raise BadRequest({'message': 'Missing natural key.'})
+    row = session.execute(
+        insert_statement(model, [data], upsert=True).returning(
+            *returning(model) +
+            [literal_column('xmax = 0', Boolean).label('inserted')])
+    ).first()
+    return model.serializer()(row), row.inserted
+
+
+def delete_row(session, model, id):
+    table = model.__table__
+    row = session.execute(
+        table.delete().where(table.c.id == id).returning(table.c.id)
+    ).first()
+    if not row:
+        raise NotFound()
+
+
+resources = OrderedDict()
+preparers = {}
+
+
+async def prepare(model, op, rows, auth, hasher):
+    """
+    Runs the hook `common_routes` registered for `model` on the values
+    about to be written by `op`: 'create', 'update' or 'upsert'.
+    """
+    hook = preparers.get(model)
+    rows = [values for values in rows if values]
+    if hook is not None and rows:
+        await hook(op, rows, auth, hasher)
+
+
 def create_route(model):
-    async def func(data: model._scheme, session: Session):
-        data.pop('id')
-        obj = model(**data)
-        session.add(obj)
-        session.commit()
-        return http.Response(obj.render(), status=201)
+    async def func(
+        data: model._scheme,
+        auth: Auth,
+        session: AsyncSession,
+        hasher: PasswordHasher,
+        cache: Cache
+    ):
+        await prepare(model, 'create', [data], auth, hasher)
+        rendered = await session.write(create_row, model, data)
+        invalidate(cache, model, [rendered['id']])
+        return http.Response(rendered, status=201)
     return Route(
         '/', 'POST', func, name="create_{}".format(model.__name__.lower()))
 
 
+def bulk_create_route(model):
+    async def func(
+        body: http.Body,
+        content_type: http.Header,
+        auth: Auth,
+        session: AsyncSession,
+        hasher: PasswordHasher,
+        cache: Cache
+    ):
+        count, rows, errors = parse_rows(model, body, content_type)
+        await prepare(
+            model, 'create', [values for index, values in rows], auth, hasher)
+        created, failed = await session.run(bulk_insert, model, rows)
+        invalidate(cache, model, created.values())
+        errors.update(failed)
+        return bulk_response(count, created, errors)
+    return Route(
+        '/bulk', 'POST', func,
+        name="bulk_create_{}s".format(model.__name__.lower()))
+
+
+def upsert_route(model):
+    async def func(
+        data: model._scheme,
+        auth: Auth,
+        session: AsyncSession,
+        hasher: PasswordHasher,
+        cache: Cache
+    ):
+        await prepare(model, 'upsert', [data], auth, hasher)
+        rendered, inserted = await session.write(upsert_row, model, data)
+        invalidate(cache, model, [rendered['id']])
+        return http.Response(rendered, status=201 if inserted else 200)
+    return Route(
+        '/', 'PUT', func, name="upsert_{}".format(model.__name__.lower()))
+
+
+def bulk_upsert_route(model):
+    async def func(
+        body: http.Body,
+        content_type: http.Header,
+        auth: Auth,
+        session: AsyncSession,
+        hasher: PasswordHasher,
+        cache: Cache
+    ):
+        count, rows, errors = parse_rows(model, body, content_type)
+        await prepare(
+            model, 'upsert', [values for index, values in rows], auth, hasher)
+        created, failed = await session.run(bulk_upsert, model, rows)
+        invalidate(cache, model, created.values())
+        errors.update(failed)
+        return bulk_response(count, created, errors)
+    return Route(
+        '/bulk', 'PUT', func,
+        name="bulk_upsert_{}s".format(model.__name__.lower()))
+
+
 def view_route(model):
-    async def func(id: int, session: Session):
-        obj = session.query(model).filter(
-            model.id == id
-        ).first()
-        if not obj:
-            raise NotFound()
-        return obj.render()
+    async def func(
+        id: int,
+        fields: bind(Fields, model),
+        include: bind(Includes, model),
+        if_none_match: http.Header,
+        session: AsyncSession,
+        cache: Cache,
+        encoder: Encoder
+    ):
+        def view(session):
+            columns = model.columns()
+            columns += join_columns(model, include or [], columns)
+            row = session.query(*columns).filter(
+                model.id == id
+            ).first()
+            if not row:
+                raise NotFound()
+            return embed(
+                session, model, include or [], [row],
+                [model.serializer()(row)])[0]
+
+        if include:
+            rendered = await session.run(view)
+            content = None
+        else:
+            key = cache_key(model, id)
+            cached = cache.get(key)
+            if cached is None:
+                generation = cache.generation(key)
+                rendered = await session.run(view)
+                cached = (rendered, encoder.dumps(rendered))
+                cache.set(key, cached, generation)
+            rendered, content = cached
+        if fields:
+            rendered = OrderedDict(
+                (field, rendered[field]) for field in fields + (include or []))
+            content = None
+        if content is None:
+            content = encoder.dumps(rendered)
+        return json_response(content, if_none_match)
     return Route(
         '/{id}',
         'GET', func, name="view_{}".format(model.__name__.lower()))
@@ -118,40 +1025,46 @@ def update_route(model):
     async def func(
         id: int,
         data: model._scheme,
-        session: Session
+        auth: Auth,
+        session: AsyncSession,
+        hasher: PasswordHasher,
+        cache: Cache
     ):
-        if data:
-            data.pop('id')
-        obj = session.query(model).filter(
-            model.id == id
-        ).first()
-        if not obj:
-            raise NotFound()
-        for key, value in data.items():
-            setattr(obj, key, value)
-        session.commit()
-        return obj.render()
+        await prepare(model, 'update', [data], auth, hasher)
+        try:
+            return await session.write(update_row, model, id, data)
+        finally:
+            invalidate(cache, model, [id])
     return Route(
         '/{id}',
         'PATCH', func, name="update_{}".format(model.__name__.lower()))
 
 
 def delete_route(model):
-    async def func(id: int, session: Session):
-        deleted = session.query(model).filter(
-            model.id == id
-        ).delete()
-        if not deleted:
-            raise NotFound()
-        session.commit()
+    async def func(id: int, session: AsyncSession, cache: Cache):
+        try:
+            await session.run(delete_row, model, id)
+        finally:
+            invalidate(cache, model, [id])
         return http.Response(status=204)
     return Route(
         '/{id}',
         'DELETE', func, name="delete_{}".format(model.__name__.lower()))
 
 
-def common_routes(model, exclude=[]):
-    return [func(model) for func in [
-        list_route, create_route, view_route, update_route, delete_route]
-        if func.__name__ not in exclude
-    ]
+def common_routes(model, exclude=[], prepare=None):
+    """
+    Returns the CRUD routes of `model`. `prepare(op, rows, auth, hasher)`
+    is awaited before `rows` are created, updated or upserted through
+    them or the batch endpoint.
+    """
+    resources[model.__tablename__] = model
+    if prepare is not None:
+        preparers[model] = prepare
+    factories = [
+        list_route, aggregate_route, create_route, bulk_create_route,
+        view_route, update_route, delete_route]
+    if model._scheme.natural_key:
+        factories += [upsert_route, bulk_upsert_route]
+    return [func(model) for func in factories
+            if func.__name__ not in exclude]
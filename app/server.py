@@ -1,24 +1,157 @@
 from uvicorn.run import UvicornServer
 from uvicorn.protocols import http
+import os
+import time
+import signal
+import socket
+import asyncio
+import logging
 import functools
 import aiohttp_autoreload
+from apistar.exceptions import CommandLineError
 from apistar.interfaces import App
+from cache import Cache
+
+
+logger = logging.getLogger()
 
 
 class ReloadingServer(UvicornServer):
+    def __init__(self, sock=None, drain_timeout=30):
+        super().__init__()
+        self.sock = sock
+        self.drain_timeout = drain_timeout
+        self.in_flight = 0
+
     async def create_server(self, loop, app, host, port):
         if getattr(app, 'debug_mode', None):
             aiohttp_autoreload.start()
+
+        async def consumer(message, channels):
+            self.in_flight += 1
+            try:
+                await app(message, channels)
+            finally:
+                self.in_flight -= 1
+
         protocol = functools.partial(
-            http.HttpProtocol, consumer=app, loop=loop)
-        server = await loop.create_server(protocol, host=host, port=port)
+            http.HttpProtocol, consumer=consumer, loop=loop)
+        if self.sock is not None:
+            server = await loop.create_server(protocol, sock=self.sock)
+        else:
+            server = await loop.create_server(protocol, host=host, port=port)
         self.servers.append(server)
 
+    async def tick(self, loop):
+        while self.alive:
+            http.set_time_and_date()
+            await asyncio.sleep(1)
+
+        logger.warning("Stopping worker [{}]".format(os.getpid()))
+
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+        deadline = loop.time() + self.drain_timeout
+        while self.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        loop.stop()
+
+
+class Supervisor():
+    """
+    Pre-forks worker processes that share one listening socket, restarts
+    the ones that die and lets them all drain on SIGTERM.
+    """
+    def __init__(self, app, host, port, workers):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.pids = {}
+        self.alive = True
+
+    def run(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(2048)
+        self.sock.set_inheritable(True)
+
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGQUIT, self.handle_exit)
+
+        logger.warning('Starting supervisor [{}] with {} workers'.format(
+            os.getpid(), self.workers))
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.pids.pop(pid, None)
+            if started is None or not self.alive:
+                continue
+            logger.warning('Worker [{}] died with status {}'.format(
+                pid, status))
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            self.spawn()
+
+        self.sock.close()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = time.monotonic()
+            return
+
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+            signal.signal(sig, signal.SIG_DFL)
+        status = 1
+        try:
+            ReloadingServer(sock=self.sock).run(self.app, self.host, self.port)
+            status = 0
+        except Exception:
+            logger.exception('Worker [{}] crashed'.format(os.getpid()))
+        finally:
+            os._exit(status)
+
+    def handle_exit(self, sig, frame):
+        self.alive = False
+        for pid in list(self.pids):
+            os.kill(pid, signal.SIGTERM)
+
 
 def run(app: App,
         host: str='127.0.0.1',
         port: int=8080,
-        debug: bool=True):
+        debug: bool=True,
+        workers: int=1):
+    """
+    Run the API server.
+
+    Args:
+      host: The host of the server.
+      port: The port of the server.
+      debug: Turn the debugger and autoreload [on|off].
+      workers: The number of worker processes, with --no-debug only.
+        Each one has its own view cache, so with more than one the cache
+        keeps entries for CACHE['WORKERS_TTL'] seconds, by default none.
+    """
+    if debug and workers > 1:
+        raise CommandLineError(
+            'Autoreload runs a single process, pass --no-debug to run '
+            '{} workers'.format(workers))
     app.debug_mode = debug
 
-    ReloadingServer().run(app, host, port)
+    if workers < 2:
+        ReloadingServer().run(app, host, port)
+    else:
+        app.preloaded_state[Cache].share(workers)
+        Supervisor(app, host, port, workers).run()
@@ -1,21 +1,42 @@
 import os
+import json
+import time
+import zlib
+import signal
+import socket
+import asyncio
+import threading
+import multiprocessing
 import pytest
 from datetime import datetime
+from decimal import Decimal
 
 import jwt
 from faker import Faker
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy import event
+from sqlalchemy.exc import DataError, OperationalError
+from sqlalchemy.orm import Query, sessionmaker
 
-from apistar import Settings
+from apistar import Settings, typesystem
+from apistar.exceptions import CommandLineError
 from apistar.backends.sqlalchemy_backend import SQLAlchemyBackend
 from apistar.test import TestClient
 from apistar.backends.sqlalchemy_backend import Session
 
 from app import app
-from db_base import Base
+from db_base import Base, Serializer, converter
+from async_session import SessionPool, WriteBatcher
+from cache import Cache
+from compression import Compressor
+from encoders import Encoder, get_encoder
+from instrumentation import Metrics
+from metrics import public_metrics
+from migrations.commands import report_slow_filters
+from server import ReloadingServer, Supervisor
+from benchmarks import summarize, micro_benchmarks
+from rest_utils import Filters, encode_cursor
+from users.passwords import PasswordHasher
 from utils import get_component
 from users.models import User
 from projects.models import Project
@@ -41,10 +62,9 @@ def session(request):
     except Exception as e:
         pass
 
-    engine_new = create_engine(
+    engine_new = backend.create_engine(
         'postgresql://{e[DB_USER]}:{e[DB_PASSWORD]}@{e[DB_HOST]}/test_database'  # nopep8
-        .format(e=os.environ),
-        poolclass=NullPool
+        .format(e=os.environ)
     )
 
     backend.engine = engine_new
@@ -75,6 +95,482 @@ def client(settings):
     return clnt
 
 
+def test_session_pool_does_not_block(session):
+    pool = get_component(SessionPool)
+
+    def sleep(session):
+        session.execute("SELECT pg_sleep(0.2)")
+
+    async def run_concurrently():
+        await asyncio.gather(*[pool.run(sleep) for _ in range(3)])
+
+    start = time.monotonic()
+    asyncio.get_event_loop().run_until_complete(run_concurrently())
+
+    assert time.monotonic() - start < 0.5
+    assert pool.stats()['checkedout'] == 0
+
+
+def test_session_pool_statement_timeout(session):
+    pool = get_component(SessionPool)
+
+    def sleep(session):
+        session.execute("SELECT pg_sleep(1)")
+
+    with pytest.raises(OperationalError):
+        asyncio.get_event_loop().run_until_complete(
+            pool.run(sleep, timeout=50))
+
+
+def test_write_batcher_isolates_failures(session):
+    batcher = WriteBatcher(
+        get_component(SessionPool), {'DATABASE': {'WRITE_BATCH_WINDOW': 20}})
+    names = [fake.uuid4() for _ in range(3)]
+
+    def create(session, name, user_id=None):
+        obj = Project(name=name, user_id=user_id)
+        session.add(obj)
+        session.flush()
+        return obj.id
+
+    async def write_concurrently():
+        return await asyncio.gather(
+            batcher.run(create, names[0]),
+            batcher.run(create, names[1], -1),
+            batcher.run(create, names[2]),
+            return_exceptions=True)
+
+    first, failed, last = asyncio.get_event_loop().run_until_complete(
+        write_concurrently())
+
+    assert isinstance(first, int) and isinstance(last, int)
+    assert isinstance(failed, Exception)
+    assert (batcher.batches, batcher.writes) == (1, 3)
+    query = session.query(Project).filter(Project.name.in_(names))
+    assert sorted(obj.id for obj in query) == sorted([first, last])
+    query.delete(synchronize_session=False)
+    session.commit()
+
+
+def test_worker_drains_in_flight_requests_on_exit():
+    loop = asyncio.new_event_loop()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(8)
+    sock.setblocking(False)
+    server = ReloadingServer(sock=sock, drain_timeout=5)
+    replies = []
+
+    async def slow_app(message, channels):
+        await asyncio.sleep(0.5)
+        await channels['reply'].send(
+            {'status': 200, 'headers': [], 'content': b'done'})
+
+    def request():
+        with socket.create_connection(sock.getsockname()) as client:
+            client.sendall(b'GET / HTTP/1.1\r\nHost: test\r\n\r\n')
+            reply = b''
+            while not reply.endswith(b'done'):
+                chunk = client.recv(1024)
+                if not chunk:
+                    break
+                reply += chunk
+            replies.append(reply)
+
+    loop.run_until_complete(server.create_server(loop, slow_app, None, None))
+    thread = threading.Thread(target=request)
+    thread.start()
+    loop.call_later(0.2, server.handle_exit, signal.SIGTERM, None)
+    loop.create_task(server.tick(loop))
+    loop.run_forever()
+    thread.join(5)
+    loop.close()
+
+    assert replies and replies[0].endswith(b'done')
+    assert server.in_flight == 0
+    with pytest.raises(OSError):
+        socket.create_connection(sock.getsockname(), timeout=1)
+
+
+def test_run_rejects_workers_in_debug_mode():
+    with pytest.raises(CommandLineError):
+        app.main(['run', '--workers', '2'], standalone_mode=False)
+
+
+def test_supervisor_restarts_crashed_workers(tmp_path, monkeypatch):
+    started = tmp_path / 'started'
+
+    def crash_once(self, app, host, port):
+        with open(str(started), 'a') as log:
+            log.write('{}\n'.format(os.getpid()))
+        try:
+            os.close(os.open(
+                str(tmp_path / 'crashed'), os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            signal.pause()
+        raise RuntimeError('crash')
+
+    def pids():
+        if not started.exists():
+            return []
+        return [int(pid) for pid in started.read_text().split()]
+
+    monkeypatch.setattr(ReloadingServer, 'run', crash_once)
+    supervisor = multiprocessing.get_context('fork').Process(
+        target=Supervisor(None, '127.0.0.1', 0, 2).run)
+    supervisor.start()
+    deadline = time.monotonic() + 10
+    while len(pids()) < 3 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    os.kill(supervisor.pid, signal.SIGTERM)
+    supervisor.join(10)
+
+    assert len(pids()) == 3
+    assert supervisor.exitcode == 0
+    for pid in pids():
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+
+def test_token_cache(settings, anon_client):
+    authentication = settings['AUTHENTICATION'][0]
+    token = jwt.encode(
+        {'user_id': 1, 'exp': int(time.time()) + 60},
+        settings['JWT_SECRET'],
+        algorithm='HS256'
+    ).decode('utf-8')
+    anon_client.headers.update({'Authorization': 'Bearer {}'.format(token)})
+    hits, misses = authentication.hits, authentication.misses
+
+    responses = [anon_client.get('/projects/') for _ in range(3)]
+
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert authentication.hits - hits == 2
+    assert authentication.misses - misses == 1
+
+
+def test_token_cache_expiry(settings, anon_client):
+    authentication = settings['AUTHENTICATION'][0]
+    token = jwt.encode(
+        {'user_id': 1, 'exp': int(time.time()) + 60},
+        settings['JWT_SECRET'],
+        algorithm='HS256'
+    ).decode('utf-8')
+    header = 'Bearer {}'.format(token)
+    anon_client.headers.update({'Authorization': header})
+
+    response1 = anon_client.get('/projects/')
+    auth, _ = authentication.cache[header]
+    authentication.cache[header] = (auth, time.time() - 1)
+    response2 = anon_client.get('/projects/')
+
+    assert response1.status_code == 200
+    assert response2.status_code == 200
+    assert authentication.cache[header][1] > time.time()
+
+
+def test_local_memory_cache_evicts_lru(settings):
+    cache = type(get_component(Cache))({'CACHE': {'SIZE': 2, 'TTL': 60}})
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+
+def test_local_memory_cache_skips_stale_sets(settings):
+    cache = type(get_component(Cache))({'CACHE': {'SIZE': 1, 'TTL': 60}})
+    generation = cache.generation('a')
+    cache.delete('a')
+    cache.set('a', 'stale', generation)
+    cache.set('b', 'fresh', cache.generation('b'))
+    cache.delete('c')
+    cache.delete('d')
+    cache.set('e', 'pruned', generation)
+
+    assert cache.get('a') is None
+    assert cache.get('b') == 'fresh'
+    assert cache.get('e') is None
+
+
+def test_local_memory_cache_shared_by_workers(settings):
+    cls = type(get_component(Cache))
+    single = cls({'CACHE': {'TTL': 60}})
+    off = cls({'CACHE': {'TTL': 60}})
+    short = cls({'CACHE': {'TTL': 60, 'WORKERS_TTL': 1}})
+    single.share(1)
+    off.set('a', 1)
+    off.share(4)
+    short.share(4)
+    off.set('b', 2)
+    short.set('c', 3)
+
+    assert single.ttl == 60
+    assert off.get('a') is None
+    assert off.get('b') is None
+    assert short.ttl == 1
+    assert short.get('c') == 3
+
+
+def test_benchmark_summary():
+    summary = summarize([i / 1000 for i in range(100, 0, -1)], 2.0, 1)
+
+    assert summary['rps'] == 50
+    assert summary['errors'] == 1
+    assert round(summary['p50_ms']) == 51
+    assert round(summary['p99_ms']) == 100
+
+
+def test_micro_benchmarks():
+    results = micro_benchmarks(10)
+
+    assert set(results) == {
+        'render_us', 'dumps_100_us', 'filters_uncached_us',
+        'filters_cached_us', 'ordering_us'}
+    assert all(value > 0 for value in results.values())
+
+
+def test_serializer_converts_only_mismatched_fields():
+    assert User.serializer().converters == []
+    assert Project.serializer().converters == []
+    assert converter(Project, 'id', typesystem.String) is typesystem.String
+    assert Project.serializer(['name'])(Project(name='x')) == {'name': 'x'}
+
+
+def test_metrics(session, client, anon_client):
+    client.get('/projects/')
+    response = client.get('/metrics')
+    samples = dict(
+        line.rsplit(' ', 1) for line in response.text.splitlines()
+        if not line.startswith('#')
+    )
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert int(samples[
+        'http_requests_total{route="list_projects",method="GET",status="200"}'
+    ]) >= 1
+    assert int(samples[
+        'http_request_db_queries_total{route="list_projects"}']) >= 2
+    assert float(samples[
+        'http_request_auth_seconds_total{route="list_projects"}']) > 0
+    assert 'http_request_duration_seconds_count{route="list_projects"}' in \
+        samples
+    assert 'db_pool{stat="checkouts"}' in samples
+    assert 'response_cache{stat="hits"}' in samples
+
+
+def test_metrics_need_authentication(anon_client):
+    response = anon_client.get('/metrics')
+
+    assert response.status_code == 401
+    assert public_metrics.permissions == []
+
+
+@pytest.fixture
+def clean_projects(session):
+    yield
+    session.rollback()
+    session.query(Project).delete()
+    session.commit()
+
+
+def test_batch(session, clean_projects, client):
+    session.merge(User(id=1234))
+    existing = Project(name='old', user_id=1234)
+    doomed = Project(name='doomed', user_id=1234)
+    session.add_all([existing, doomed])
+    session.commit()
+    doomed_id = doomed.id
+
+    response = client.post('/batch', json=[
+        {'op': 'create', 'resource': 'projects', 'data': {'name': 'new'}},
+        {'op': 'update', 'resource': 'projects', 'id': existing.id,
+         'data': {'name': 'renamed'}},
+        {'op': 'delete', 'resource': 'projects', 'id': doomed_id},
+    ])
+
+    assert response.status_code == 200
+    created, updated, deleted = response.json()
+    assert created['status'] == 201 and created['body']['user_id'] == 1234
+    assert updated == {'status': 200, 'body': dict(
+        existing.render(), name='renamed')}
+    assert deleted == {'status': 204}
+    session.expunge(doomed)
+    assert session.query(Project).get(created['body']['id']).name == 'new'
+    assert session.query(Project).get(doomed_id) is None
+
+
+def test_batch_is_atomic(session, clean_projects, client):
+    name = fake.uuid4()
+
+    response = client.post('/batch', json=[
+        {'op': 'create', 'resource': 'projects', 'data': {'name': name}},
+        {'op': 'delete', 'resource': 'projects', 'id': -1},
+    ])
+
+    assert response.status_code == 404
+    assert response.json()['index'] == 1
+    assert session.query(Project).filter(Project.name == name).count() == 0
+
+
+def test_stream_nothing(client):
+    response = client.get('/projects/?stream=true&filters=id==-1')
+
+    assert response.status_code == 200
+    assert response.text == ''
+
+
+def test_stream_reports_query_errors(client, monkeypatch):
+    def fail(self, count):
+        raise DataError('SELECT', {}, Exception('invalid input'))
+
+    monkeypatch.setattr(Query, 'yield_per', fail)
+    response = client.get('/projects/?stream=true')
+
+    assert response.status_code == 500
+    assert response.json() == {'message': 'Unexpected error'}
+
+
+@pytest.mark.parametrize("body", [
+    {'op': 'create'},
+    [{'op': 'drop', 'resource': 'projects', 'id': 1}],
+    [{'op': 'delete', 'resource': 'nope', 'id': 1}],
+    [{'op': 'update', 'resource': 'users', 'id': '1', 'data': {}}],
+    [{'op': 'create', 'resource': 'users', 'data': {'id': 'x'}}],
+    [{'op': 'create', 'resource': 'projects', 'data': 'x'}],
+    [{'op': 'update', 'resource': 'projects', 'id': 1, 'data': [1]}],
+    [{'op': 'update', 'resource': 'projects', 'id': 1, 'data': []}],
+    [{'op': 'update', 'resource': 'projects', 'id': 1, 'data': 0}],
+    [{'op': 'create', 'resource': 'projects', 'data': ''}],
+    [{'op': 'create', 'resource': 'projects', 'data': False}],
+])
+def test_invalid_batch(client, body):
+    response = client.post('/batch', json=body)
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("accept_encoding, expect", [
+    (None, None),
+    ("gzip", "gzip"),
+    ("deflate, gzip;q=0.5", "gzip"),
+    ("gzip;q=0", None),
+    ("identity", None),
+    ("*", "gzip"),
+    ("*, gzip;q=0", None),
+])
+def test_negotiate_encoding(accept_encoding, expect):
+    compressor = Compressor({'COMPRESSION': {'ENCODINGS': ['gzip']}})
+
+    assert compressor.negotiate(accept_encoding) == expect
+
+
+def test_compressed_responses(session, clean_projects, client):
+    session.add_all([Project(name=fake.word()) for _ in range(100)])
+    session.commit()
+    gzip = {'Accept-Encoding': 'gzip'}
+
+    listed = client.get('/projects/', headers=gzip)
+    streamed = client.get('/projects/?stream=true', headers=gzip)
+    small = client.get('/projects/?limit=1', headers=gzip)
+    plain = client.get('/projects/', headers={'Accept-Encoding': 'identity'})
+
+    assert listed.headers['Content-Encoding'] == 'gzip'
+    assert listed.headers['ETag'].startswith('W/"')
+    assert listed.json() == plain.json()
+    assert len(listed.json()) == 100
+    assert streamed.headers['Content-Encoding'] == 'gzip'
+    assert len(streamed.text.splitlines()) == 100
+    assert 'Content-Encoding' not in small.headers
+    assert small.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in plain.headers
+    assert not plain.headers['ETag'].startswith('W/')
+
+    revalidated = client.get('/projects/', headers=dict(
+        gzip, **{'If-None-Match': listed.headers['ETag']}))
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == listed.headers['ETag']
+    assert revalidated.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in revalidated.headers
+
+
+def test_gzip_is_deterministic():
+    gzip = Compressor({'COMPRESSION': {'ENCODINGS': ['gzip']}}).encodings[
+        'gzip']
+    data = b'{"name": "compressed"}' * 100
+
+    assert gzip.compress(data) == gzip.compress(data)
+    assert zlib.decompress(gzip.compress(data), 16 + zlib.MAX_WBITS) == data
+
+
+def test_encoder_handles_dates_and_decimals():
+    encoder = Encoder('json')
+
+    assert json.loads(encoder.dumps({
+        'at': datetime(2017, 11, 5, 12, 30),
+        'price': Decimal('10.10'),
+        'ids': {1: 'one'},
+    })) == {'at': '2017-11-05T12:30:00', 'price': '10.10', 'ids': {'1': 'one'}}
+    assert encoder.dumps_lines([1, 'two']) == b'1\n"two"\n'
+    with pytest.raises(TypeError):
+        encoder.dumps(object())
+
+
+def test_unknown_encoder():
+    with pytest.raises(ValueError):
+        Encoder('simdjson')
+
+
+def test_password_hasher_pool_starts_from_a_fork_server():
+    hasher = PasswordHasher({'PASSWORD_HASHING': {
+        'CONTEXT': {
+            'schemes': ['pbkdf2_sha512'],
+            'pbkdf2_sha512__default_rounds': 1000,
+        },
+        'WORKERS': 1,
+    }})
+    loop = asyncio.new_event_loop()
+    try:
+        password = loop.run_until_complete(hasher.hash('secret'))
+        assert loop.run_until_complete(hasher.verify('secret', password))
+        assert hasher.executor._mp_context.get_start_method() == 'forkserver'
+    finally:
+        hasher.executor.shutdown()
+        loop.close()
+
+
+def test_encoder_is_per_app():
+    default = get_component(Encoder)
+
+    assert app.encoder is default
+    assert get_encoder({'JSON_ENCODER': 'json'}).name == 'json'
+    assert get_component(Encoder) is default
+
+
+def test_slow_query_log(session, caplog, monkeypatch):
+    monkeypatch.setattr(get_component(Metrics), 'slow_query', 1e-6)
+    pool = get_component(SessionPool)
+
+    asyncio.get_event_loop().run_until_complete(
+        pool.run(lambda session: session.execute("SELECT 42")))
+
+    assert 'SELECT 42' in caplog.text
+
+
+def test_malformed_authorization_header(anon_client):
+    anon_client.headers.update({'Authorization': 'Bearer'})
+
+    response = anon_client.get('/projects/')
+
+    assert response.status_code == 401
+
+
 class BaseTestViewSet(object):
     def _mock_obj(self):
         return {}
@@ -99,6 +595,7 @@ class BaseTestViewSet(object):
     def clean_db(self, session):
         session.query(self.model).delete()
         session.commit()
+        get_component(Cache).clear()
 
     def test_list(self, clean_db, session: Session, client: TestClient):
         obj = self._create_obj(session)
@@ -136,6 +633,83 @@ class BaseTestViewSet(object):
         assert response.status_code == 200
         assert response.json() == new_obj.render()
 
+    def test_view_cached(self, new_obj: Base, client: TestClient):
+        cache = get_component(Cache)
+        url = '/{}/{}'.format(self.url, new_obj.id)
+        response1 = client.get(url)
+        hits = cache.stats()['hits']
+        response2 = client.get(url)
+
+        assert response2.status_code == 200
+        assert response2.json() == response1.json()
+        assert cache.stats()['hits'] == hits + 1
+
+    def test_view_not_cached_when_invalidated_during_read(
+        self,
+        new_obj: Base,
+        client: TestClient,
+        monkeypatch
+    ):
+        cache = get_component(Cache)
+        generation = cache.generation
+
+        def invalidated_during_read(key):
+            current = generation(key)
+            cache.delete(key)
+            return current
+
+        monkeypatch.setattr(cache, 'generation', invalidated_during_read)
+        client.get('/{}/{}'.format(self.url, new_obj.id))
+
+        assert cache.get((self.model.__tablename__, new_obj.id)) is None
+
+    def test_update_invalidates_cache(
+        self,
+        new_obj: Base,
+        mock: dict,
+        client: TestClient
+    ):
+        url = '/{}/{}'.format(self.url, new_obj.id)
+        client.get(url)
+        response = client.patch(url, data=mock)
+
+        assert client.get(url).json() == response.json()
+
+    def test_delete_invalidates_cache(self, new_obj: Base, client: TestClient):
+        url = '/{}/{}'.format(self.url, new_obj.id)
+        client.get(url)
+        client.delete(url)
+
+        assert client.get(url).status_code == 404
+
+    def test_view_not_modified(
+        self,
+        new_obj: Base,
+        mock: dict,
+        client: TestClient
+    ):
+        url = '/{}/{}'.format(self.url, new_obj.id)
+        field = next(iter(mock))
+        tag = client.get(url).headers['ETag']
+        response = client.get(url, headers={'If-None-Match': tag})
+        client.patch(url, data={
+            field: '{}-changed'.format(getattr(new_obj, field))})
+        changed = client.get(url, headers={'If-None-Match': tag})
+
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['ETag'] == tag
+        assert changed.status_code == 200
+        assert changed.headers['ETag'] != tag
+
+    def test_list_not_modified(self, new_obj: Base, client: TestClient):
+        url = '/{}/'.format(self.url)
+        tag = client.get(url).headers['ETag']
+        response = client.get(url, headers={'If-None-Match': tag})
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == tag
+
     def test_delete(self, new_obj: Base, session: Session, client: TestClient):
         query = session.query(self.model).filter_by(id=new_obj.id)
         response = client.delete('/{}/{}'.format(self.url, new_obj.id))
@@ -163,6 +737,51 @@ class BaseTestViewSet(object):
         assert response.json() == self.model(**mock).render()
         assert response.json() == new_obj.render()
 
+    def test_bulk_create(self, clean_db, session: Session, client):
+        mocks = [self._mock_obj(), self._mock_obj()]
+
+        response = client.post('/{}/bulk'.format(self.url), json=mocks)
+        ids = response.json()['ids']
+
+        objs = session.query(self.model).order_by(self.model.id).all()
+
+        assert response.status_code == 201
+        assert response.json()['errors'] == {}
+        assert [obj.id for obj in objs] == ids
+        for obj, mock in zip(objs, mocks):
+            rendered = obj.render()
+            assert all(rendered[key] == value for key, value in mock.items()
+                       if key in rendered)
+
+    def test_bulk_create_ndjson(self, clean_db, session: Session, client):
+        lines = [
+            json.dumps(self._mock_obj()),
+            '{"broken',
+            json.dumps({"id": "abc"}),
+            json.dumps("ab"),
+            json.dumps(self._mock_obj()),
+        ]
+
+        response = client.post(
+            '/{}/bulk'.format(self.url),
+            data='\n'.join(lines),
+            headers={'Content-Type': 'application/x-ndjson'}
+        )
+        ids = response.json()['ids']
+
+        assert response.status_code == 207
+        assert ids[1:4] == [None, None, None]
+        assert sorted(response.json()['errors']) == ['1', '2', '3']
+        assert session.query(self.model).count() == 2
+
+    def test_bulk_create_non_objects(self, clean_db, session, client):
+        response = client.post(
+            '/{}/bulk'.format(self.url), json=[self._mock_obj(), "ab", 1])
+
+        assert response.status_code == 207
+        assert response.json()['ids'][1:] == [None, None]
+        assert sorted(response.json()['errors']) == ['1', '2']
+
     @pytest.mark.parametrize("method, id", [
         ("GET", 3),
         ("PATCH", 3),
@@ -177,6 +796,7 @@ class BaseTestViewSet(object):
     @pytest.mark.parametrize("method, url", [
         ("GET", '/{}/3'),
         ("POST", '/{}/'),
+        ("POST", '/{}/bulk'),
         ("PATCH", '/{}/3'),
         ("DELETE", '/{}/3'),
     ])
@@ -209,6 +829,97 @@ class TestUserViewSet(BaseTestViewSet):
 
         assert user.password == mock['password']
 
+    @pytest.fixture
+    def hashed(self, monkeypatch):
+        hasher = get_component(PasswordHasher)
+        hashed = []
+        hash_many = hasher.hash_many
+
+        async def record(secrets):
+            hashed.extend(secrets)
+            return await hash_many(secrets)
+
+        monkeypatch.setattr(hasher, 'hash_many', record)
+        return hashed
+
+    def test_update_password(self, new_obj, hashed, session, client):
+        response = client.patch(
+            '/users/{}'.format(new_obj.id), json={"password": "changed"})
+        batched = client.post('/batch', json=[{
+            'op': 'update', 'resource': 'users', 'id': new_obj.id,
+            'data': {'password': 'batched'}}])
+
+        assert response.status_code == 200
+        assert batched.status_code == 200
+        assert hashed == ["changed", "batched"]
+        session.expire_all()
+        assert session.query(User).get(new_obj.id).password == "batched"
+
+    def test_upsert_password(self, new_obj, hashed, session, client):
+        response = client.put('/users/', json={
+            "email": new_obj.email, "password": "upserted"})
+        bulk = client.put('/users/bulk', json=[{
+            "email": new_obj.email, "password": "bulk"}])
+
+        assert response.status_code == 200
+        assert bulk.status_code == 201
+        assert hashed == ["upserted", "bulk"]
+        session.expire_all()
+        assert session.query(User).get(new_obj.id).password == "bulk"
+
+    def test_bulk_password(self, clean_db, mock, session, client):
+        response = client.post('/users/bulk', json=[mock])
+        user = session.query(User).get(response.json()['ids'][0])
+
+        assert user.password == mock['password']
+
+    def test_create_duplicate_email(self, new_obj, mock, client):
+        response = client.post('/users/', json=dict(mock, email=new_obj.email))
+
+        assert response.status_code == 409
+
+    def test_update_duplicate_email(self, new_obj, session, client):
+        other = self._create_obj(session)
+
+        response = client.patch(
+            '/users/{}'.format(other.id), json={"email": new_obj.email})
+
+        assert response.status_code == 409
+
+    def test_upsert(self, clean_db, mock, session, client):
+        created = client.put('/users/', json=mock)
+        updated = client.put('/users/', json={
+            "email": mock['email'], "first_name": "Renamed"})
+
+        assert created.status_code == 201
+        assert updated.status_code == 200
+        assert updated.json() == dict(created.json(), first_name="Renamed")
+        user = session.query(User).get(created.json()['id'])
+        assert user.password == mock['password']
+
+    def test_upsert_needs_natural_key(self, clean_db, client):
+        response = client.put('/users/', json={"first_name": "Nobody"})
+
+        assert response.status_code == 400
+
+    def test_bulk_upsert(self, clean_db, session, client):
+        existing = self._create_obj(session)
+        email = fake.email()
+
+        response = client.put('/users/bulk', json=[
+            {"email": existing.email, "last_name": "Updated"},
+            {"email": email, "last_name": "Inserted"},
+            {"last_name": "Keyless"},
+        ])
+
+        assert response.status_code == 207
+        ids = response.json()['ids']
+        assert ids[0] == existing.id and ids[2] is None
+        assert response.json()['errors'] == {'2': 'Missing natural key.'}
+        session.expire_all()
+        assert existing.last_name == "Updated"
+        assert session.query(User).get(ids[1]).email == email
+
     def test_password_not_exposed(self, new_obj, client: TestClient):
         response = client.get('/{}/{}'.format(self.url, new_obj.id))
 
@@ -267,6 +978,23 @@ class TestUserViewSet(BaseTestViewSet):
         assert response.status_code == 400
         assert {"message": "Email and password do not match"}
 
+    def test_password_checks_rejected_when_saturated(
+        self,
+        new_obj: User,
+        anon_client: TestClient
+    ):
+        hasher = get_component(PasswordHasher)
+        hasher.pending = hasher.max_pending
+        try:
+            response = anon_client.post('/tokens/', data={
+                "username": new_obj.email,
+                "password": fake.password()
+            })
+        finally:
+            hasher.pending = 0
+
+        assert response.status_code == 503
+
     def test_authorization_flow(
         self,
         mock: dict,
@@ -304,6 +1032,12 @@ class TestUserViewSet(BaseTestViewSet):
             ["John Honn", "John Pintor"]),
         ("?filters=first_name~contains~or,last_name~contains~or",
             ["George Zhang", "John Pintor"]),
+        ("?filters=first_name==John;last_name==Honn",
+            ["John Honn"]),
+        ("?filters=last_name==Zhang,first_name==John;last_name==Pintor",
+            ["George Zhang", "John Pintor"]),
+        ("?filters=(last_name==Zhang,first_name==John);last_name!=Honn",
+            ["George Zhang", "John Pintor"]),
         ("?ordering=-last_name",
             ["George Zhang", "John Pintor", "John Honn"]),
         ("?limit=2",
@@ -320,8 +1054,236 @@ class TestUserViewSet(BaseTestViewSet):
             for x in response.json()
         ] == expect
 
+    @pytest.mark.parametrize("query, expect", [
+        ("?fields=first_name", [{"first_name": "George"}]),
+        ("?fields=last_name,id&cursor=", [{"last_name": "Zhang"}]),
+        ("?fields=email&count=window", [{"email": None}]),
+    ])
+    def test_list_fields(
+        self,
+        clean_db,
+        sample_users,
+        client,
+        query,
+        expect
+    ):
+        response = client.get('/users/{}&limit=1'.format(query))
+
+        assert response.status_code == 200
+        expect[0].update({'id': sample_users[0].id}
+                         if 'id' in query else {})
+        assert response.json() == expect
+
+    def test_escaped_filter_values(self, clean_db, session, client):
+        user = self._create_obj(session, data={"first_name": "a(b);c,d\\"})
+        self._create_obj(session, data={"first_name": "a"})
+
+        response = client.get(
+            '/users/?filters=first_name==a\\(b\\)\\;c\\,d\\\\')
+
+        assert response.status_code == 200
+        assert [x['id'] for x in response.json()] == [user.id]
+
+    def test_view_fields(self, new_obj, client):
+        response = client.get('/users/{}?fields=email'.format(new_obj.id))
+
+        assert response.status_code == 200
+        assert response.json() == {"email": new_obj.email}
+
+    @pytest.mark.parametrize("query", [
+        "filters=password==x",
+        "filters=projects==1",
+        "filters=id~contains~1",
+        "filters=(first_name==John",
+        "filters=first_name==John;",
+        "filters=" + "(" * 20 + "id==1" + ")" * 20,
+        "filters=id==abc",
+        "filters=id>1.5",
+        "filters=first_name==a\\",
+        "ordering=password",
+        "ordering=-projects",
+    ])
+    def test_invalid_query_params(self, clean_db, client, query):
+        response = client.get('/users/?{}'.format(query))
+
+        assert response.status_code == 400
+
+    def test_filters_compiled_once(self, clean_db, client):
+        compiler, = {
+            cls.compiler for cls in Filters.__subclasses__()
+            if cls.model is User
+        }
+        route = '/users/?filters=first_name==Cached;last_name==Once'
+        client.get(route)
+        hits = compiler.compile.cache_info().hits
+        response = client.get(route)
+
+        assert response.status_code == 200
+        assert compiler.compile.cache_info().hits == hits + 1
+
+    def test_slow_filters_reported(
+        self,
+        clean_db,
+        settings,
+        client,
+        caplog,
+        tmpdir,
+        monkeypatch
+    ):
+        monkeypatch.setitem(settings['DATABASE'], 'SLOW_FILTER_TIME', 1e-6)
+        client.get('/users/?filters=first_name==John')
+        client.get('/users/?filters=last_name~contains~o;first_name==John')
+        log = tmpdir.join('server.log')
+        log.write('\n'.join(record.getMessage() for record in caplog.records))
+
+        report = report_slow_filters(
+            str(log), get_component(SQLAlchemyBackend))
+
+        assert 'users first_name== last_name~contains~' in report
+        assert 'unindexed last_name~contains~' in report
+        assert 'users first_name==:' not in report
+
+    def test_slow_serialization_is_not_a_slow_filter(
+        self,
+        clean_db,
+        sample_users,
+        settings,
+        client,
+        caplog,
+        monkeypatch
+    ):
+        render_many = Serializer.render_many
+
+        def slow_render_many(self, objs):
+            time.sleep(0.2)
+            return render_many(self, objs)
+
+        monkeypatch.setitem(settings['DATABASE'], 'SLOW_FILTER_TIME', 100)
+        monkeypatch.setattr(Serializer, 'render_many', slow_render_many)
+        response = client.get('/users/?filters=first_name==John')
+
+        assert response.status_code == 200
+        assert not [record for record in caplog.records
+                    if 'Slow filter' in record.getMessage()]
+
+    @pytest.mark.parametrize("fields", ["password", "projects", "nope"])
+    def test_unknown_fields(self, clean_db, client, fields):
+        response = client.get('/users/?fields={}'.format(fields))
+
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize("query, headers", [
+        ("?stream=1", {}),
+        ("?stream=true&limit=5", {}),
+        ("", {"Accept": "application/x-ndjson"}),
+    ])
+    def test_list_stream(
+        self,
+        clean_db,
+        sample_users,
+        client,
+        query,
+        headers
+    ):
+        response = client.get('/users/{}'.format(query), headers=headers)
+
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/x-ndjson"
+        assert [
+            json.loads(line) for line in response.text.splitlines()
+        ] == [user.render() for user in sample_users]
+
+    def test_list_stream_with_cursor(self, clean_db, client):
+        response = client.get('/users/?stream=1&cursor=')
+
+        assert response.status_code == 400
+
+    def test_list_renders_nulls(self, clean_db, sample_users, client):
+        response = client.get('/users/')
+
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/json"
+        assert [x['email'] for x in response.json()] == [None, None, None]
+
+    @pytest.mark.parametrize("query, expect", [
+        ("?limit=2",
+            [["George Zhang", "John Honn"], ["John Pintor"]]),
+        ("?limit=2&ordering=-last_name",
+            [["George Zhang", "John Pintor"], ["John Honn"]]),
+        ("?limit=1&ordering=first_name&filters=first_name==John",
+            [["John Honn"], ["John Pintor"]]),
+        ("?limit=5",
+            [["George Zhang", "John Honn", "John Pintor"]]),
+    ])
+    def test_cursor_pagination(
+        self,
+        clean_db,
+        sample_users,
+        client,
+        query,
+        expect
+    ):
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            response = client.get(
+                '/users/{}&cursor={}'.format(query, cursor))
+            assert response.status_code == 200
+            assert response.headers["X-Total-Count"] == str(
+                sum(len(page) for page in expect))
+            pages.append([
+                "{} {}".format(x['first_name'], x['last_name'])
+                for x in response.json()
+            ])
+            cursor = response.headers.get("X-Next-Cursor")
+
+        assert pages == expect
+
+    @pytest.mark.parametrize("query, expect", [
+        ("?count=exact", '3'),
+        ("?count=window", '3'),
+        ("?count=window&limit=1", '3'),
+        ("?count=window&offset=5", '3'),
+        ("?count=window&filters=first_name==John", '2'),
+        ("?count=none", None),
+    ])
+    def test_count_modes(self, clean_db, sample_users, client, query, expect):
+        response = client.get('/users/{}'.format(query))
+
+        assert response.status_code == 200
+        assert response.headers.get("X-Total-Count") == expect
+
+    def test_estimated_count(self, clean_db, sample_users, client):
+        response = client.get('/users/?count=estimate')
+
+        assert response.status_code == 200
+        assert int(response.headers["X-Total-Count"]) >= 0
+
+    def test_estimated_count_filtered(self, clean_db, sample_users, client):
+        response = client.get(
+            '/users/?count=estimate&filters=first_name==Ada;id>0')
+
+        assert response.status_code == 200
+        assert int(response.headers["X-Total-Count"]) >= 0
+
+    @pytest.mark.parametrize("query, cursor", [
+        ("", "garbage"),
+        ("", encode_cursor(["x"])),
+        ("", encode_cursor([{"a": 1}])),
+        ("", encode_cursor([True])),
+        ("", encode_cursor([None])),
+        ("&ordering=first_name", encode_cursor([1, 1])),
+        ("&ordering=-first_name", encode_cursor(["a", "b"])),
+        ("&ordering=first_name", encode_cursor([["a"], 1])),
+    ])
+    def test_invalid_cursor(self, clean_db, client, query, cursor):
+        response = client.get('/users/?cursor={}{}'.format(cursor, query))
+
+        assert response.status_code == 400
+
     @pytest.mark.parametrize("method, url", [
         ("GET", '/{}/3'),
+        ("POST", '/{}/bulk'),
         ("PATCH", '/{}/3'),
         ("DELETE", '/{}/3'),
     ])
@@ -339,7 +1301,175 @@ class TestProjectsViewSet(BaseTestViewSet):
         }
 
     def test_create(self, mock: dict, session: Session, client: TestClient):
-        obj = User(id=1234)
-        session.add(obj)
+        session.merge(User(id=1234))
         session.commit()
         return super().test_create(mock, session, client)
+
+    def test_bulk_create(self, clean_db, session: Session, client):
+        session.merge(User(id=1234))
+        session.commit()
+        return super().test_bulk_create(clean_db, session, client)
+
+    def test_bulk_create_ndjson(self, clean_db, session: Session, client):
+        session.merge(User(id=1234))
+        session.commit()
+        return super().test_bulk_create_ndjson(clean_db, session, client)
+
+    def test_bulk_create_non_objects(self, clean_db, session, client):
+        session.merge(User(id=1234))
+        session.commit()
+        return super().test_bulk_create_non_objects(clean_db, session, client)
+
+    def test_update_missing_owner(self, new_obj, client):
+        response = client.patch(
+            '/projects/{}'.format(new_obj.id), json={"user_id": -1})
+        batched = client.post('/batch', json=[{
+            'op': 'update', 'resource': 'projects', 'id': new_obj.id,
+            'data': {'user_id': -1}}])
+
+        assert response.status_code == 400
+        assert batched.status_code == 400
+        assert batched.json()['index'] == 0
+
+    @pytest.fixture
+    def owned(self, clean_db, session):
+        owner = User(first_name="Ada", last_name="Byron")
+        session.add(owner)
+        session.commit()
+        projects = [
+            self._create_obj(session, data={"name": name, "user_id": owner.id})
+            for name in ["engine", "notes"]
+        ]
+        return owner, projects
+
+    def test_create_batched(self, clean_db, session, client, monkeypatch):
+        batcher = get_component(WriteBatcher)
+        monkeypatch.setattr(batcher, 'window', 0.01)
+        batches = batcher.batches
+
+        response = client.post('/projects/', json={'name': 'batched'})
+
+        assert response.status_code == 201
+        assert batcher.batches == batches + 1
+        assert session.query(Project).get(response.json()['id']).name == \
+            'batched'
+
+    def test_writes_are_single_statements(self, owned, client):
+        owner, projects = owned
+        expected = dict(projects[0].render(), name='one')
+        ids = [project.id for project in projects]
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+
+        engine = get_component(SQLAlchemyBackend).engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            created = client.post('/projects/', json={'name': 'single'})
+            updated = client.patch(
+                '/projects/{}'.format(ids[0]), json={'name': 'one'})
+            deleted = client.delete('/projects/{}'.format(ids[1]))
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        assert created.status_code == 201
+        assert updated.json() == expected
+        assert deleted.status_code == 204
+        assert statements == ['INSERT', 'UPDATE', 'DELETE']
+
+    def test_include_user(self, owned, session, client):
+        owner, projects = owned
+        orphan = self._create_obj(session)
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        engine = get_component(SQLAlchemyBackend).engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            response = client.get('/projects/?include=user&count=none')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        assert response.status_code == 200
+        assert response.json() == [
+            dict(project.render(), user=owner.render())
+            for project in projects
+        ] + [dict(orphan.render(), user=None)]
+        assert len(statements) == 2
+
+    def test_include_projects(self, owned, client):
+        owner, projects = owned
+
+        response = client.get(
+            '/users/{}?include=projects&fields=first_name'.format(owner.id))
+        listed = client.get(
+            '/users/?include=projects&fields=last_name'
+            '&filters=id=={}'.format(owner.id))
+
+        assert response.status_code == 200
+        assert response.json() == {
+            "first_name": "Ada",
+            "projects": [project.render() for project in projects]
+        }
+        assert listed.json() == [{
+            "last_name": "Byron",
+            "projects": [project.render() for project in projects]
+        }]
+
+    def test_include_streamed(self, owned, client):
+        owner, projects = owned
+
+        response = client.get('/projects/?include=user&stream=true')
+
+        assert [json.loads(line)['user'] for line in
+                response.text.splitlines()] == [owner.render()] * 2
+
+    @pytest.mark.parametrize("include", ["projects", "nope", "user,nope"])
+    def test_invalid_include(self, client, include):
+        response = client.get('/projects/?include={}'.format(include))
+
+        assert response.status_code == 400
+
+    def test_query_params_bound_per_model(self, clean_db, session, client):
+        for name in ["alpha", "beta"]:
+            self._create_obj(session, data={"name": name})
+
+        response = client.get('/projects/?ordering=-name&fields=name')
+
+        assert response.status_code == 200
+        assert response.json() == [{"name": "beta"}, {"name": "alpha"}]
+
+    def test_aggregate(self, owned, session, client):
+        owner, projects = owned
+        self._create_obj(session, data={"name": "orphan"})
+
+        response = client.get(
+            '/projects/aggregate?group_by=user_id&metric=count,max:name')
+        filtered = client.get(
+            '/projects/aggregate?filters=name!=notes&group_by=user_id'
+            '&limit=1')
+        total = client.get('/projects/aggregate?metric=count,min:id')
+
+        assert response.status_code == 200
+        assert response.json() == [
+            {"user_id": owner.id, "count": 2, "max_name": "notes"},
+            {"user_id": None, "count": 1, "max_name": "orphan"},
+        ]
+        assert filtered.json() == [{"user_id": owner.id, "count": 1}]
+        assert total.json() == [{"count": 3, "min_id": projects[0].id}]
+
+    @pytest.mark.parametrize("query", [
+        "group_by=nope",
+        "group_by=user",
+        "metric=sum:id",
+        "metric=max:nope",
+        "metric=",
+        "filters=nope==1",
+    ])
+    def test_invalid_aggregate(self, client, query):
+        response = client.get('/projects/aggregate?{}'.format(query))
+
+        assert response.status_code == 400
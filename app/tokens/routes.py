@@ -1,10 +1,14 @@
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import jwt
 from apistar import annotate, http, typesystem, Route, Include, Settings
-from apistar.backends.sqlalchemy_backend import Session
 from apistar.authentication import Authenticated
 from apistar.exceptions import HTTPException, BadRequest
+from async_session import AsyncSession
+from instrumentation import timing
 from users.models import User
+from users.passwords import PasswordHasher
 
 
 class LoginData(typesystem.Object):
@@ -21,26 +25,62 @@ class Unauthorized(HTTPException):
 
 
 class TokenAuthentication():
+    """
+    Keeps up to `cache_size` verified tokens, least recently used first,
+    each until its `exp`, so repeated requests skip the JWT verification.
+    """
+    def __init__(self, cache_size=1024):
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
     def authenticate(self, authorization: http.Header, settings: Settings):
+        with timing('auth'):
+            return self.verify(authorization, settings)
+
+    def verify(self, authorization, settings):
         if not authorization:
             raise Unauthorized()
-        scheme, token = authorization.split()
+
+        cached = self.cache.get(authorization)
+        if cached is not None:
+            auth, expires = cached
+            if expires is None or expires > time.time():
+                self.cache.move_to_end(authorization)
+                self.hits += 1
+                return auth
+            del self.cache[authorization]
+        self.misses += 1
+
         try:
+            scheme, token = authorization.split()
             payload = jwt.decode(
                 token, settings['JWT_SECRET'], algorithms=['HS256'])
-            return Authenticated(payload['user_id'])
-        except jwt.exceptions.InvalidTokenError:
+        except (ValueError, jwt.exceptions.InvalidTokenError):
             raise Unauthorized()
 
+        auth = Authenticated(payload['user_id'])
+        self.cache[authorization] = (auth, payload.get('exp'))
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return auth
+
 
 @annotate(permissions=[])
 async def create_token(
     data: LoginData,
-    session: Session,
+    session: AsyncSession,
+    hasher: PasswordHasher,
     settings: Settings
 ):
-    user = session.query(User).filter_by(email=data['username']).first()
-    if not user or not user.password == data['password']:
+    def get_user(session):
+        return session.query(User.id, User.password).filter_by(
+            email=data['username']
+        ).first()
+
+    user = await session.run(get_user)
+    if not user or not await hasher.verify(data['password'], user.password):
         raise BadRequest({"message": "Email and password do not match"})
     expires = (datetime.now() + timedelta(days=5)).timestamp()
     token = jwt.encode(
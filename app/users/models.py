@@ -7,6 +7,11 @@ from db_base import Base, BaseScheme
 
 class UserScheme(BaseScheme):
     render_fields = ['id', 'first_name', 'last_name', 'email']
+    filter_fields = ['id', 'first_name', 'last_name', 'email']
+    search_fields = ['first_name', 'last_name', 'email']
+    sort_fields = ['id', 'first_name', 'last_name']
+    include_fields = ['projects']
+    natural_key = ['email']
     properties = {
         "id": typesystem.integer(default=0),
         "first_name": typesystem.String,
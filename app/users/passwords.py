@@ -0,0 +1,90 @@
+import os
+import json
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+from sqlalchemy_utils.types.password import Password
+from apistar import Settings
+from apistar.exceptions import HTTPException
+
+
+class Unavailable(HTTPException):
+    default_status_code = 503
+    default_detail = 'Too many pending password checks'
+
+
+@functools.lru_cache()
+def get_context(options):
+    return CryptContext(**json.loads(options))
+
+
+def hash_password(options, secret):
+    return get_context(options).hash(secret)
+
+
+def hash_passwords(options, secrets):
+    context = get_context(options)
+    return [context.hash(secret) for secret in secrets]
+
+
+def verify_password(options, secret, hash):
+    return get_context(options).verify(secret, hash)
+
+
+class PasswordHasher():
+    """
+    Hashes and verifies passwords on a process pool, so key derivation
+    doesn't block the event loop.
+
+    Calls beyond `MAX_PENDING` outstanding ones are rejected instead of
+    queued; `pending` is the current queue depth.
+
+    The pool is started by the process that first uses it, from a fork
+    server, so its processes don't inherit the server's sockets and they
+    exit along with the worker that owns them.
+    """
+    def __init__(self, settings: Settings):
+        config = settings['PASSWORD_HASHING']
+        self.options = json.dumps(config['CONTEXT'], sort_keys=True)
+        self.max_pending = config.get('MAX_PENDING', 100)
+        self.workers = config.get('WORKERS') or os.cpu_count()
+        self.pending = 0
+        self.pid = None
+
+    @property
+    def executor(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context('forkserver'))
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise Unavailable()
+        loop = asyncio.get_event_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(
+                self.executor, func, self.options, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, secret):
+        return Password(await self.run(hash_password, secret))
+
+    async def hash_many(self, secrets):
+        size = -(-len(secrets) // self.workers)
+        chunks = await asyncio.gather(*[
+            self.run(hash_passwords, secrets[start:start + size])
+            for start in range(0, len(secrets), size or 1)
+        ])
+        return [Password(hash) for chunk in chunks for hash in chunk]
+
+    async def verify(self, secret, password):
+        if password is None or password.hash is None:
+            return False
+        return await self.run(verify_password, secret, password.hash)
@@ -1,18 +1,21 @@
 from .models import User
-from apistar import annotate, http, Include, Route
-from apistar.backends.sqlalchemy_backend import Session
+from apistar import annotate, Include
 from rest_utils import common_routes
 
 
-@annotate(permissions=[])
-async def create_user(data: User._scheme, session: Session):
-    data.pop('id')
-    obj = User(**data)
-    session.add(obj)
-    session.commit()
-    return http.Response(obj.render(), status=201)
+async def hash_passwords(op, rows, auth, hasher):
+    with_password = [
+        values for values in rows if values.get('password') is not None
+    ]
+    hashes = await hasher.hash_many(
+        [values['password'] for values in with_password])
+    for values, password in zip(with_password, hashes):
+        values['password'] = password
 
 
-routes = Include('/users', [
-    Route('/', 'POST', create_user),
-] + common_routes(User, exclude=['create_route']))
+user_routes = common_routes(User, prepare=hash_passwords)
+for route in user_routes:
+    if route.name == 'create_user':
+        annotate(permissions=[])(route.view)
+
+routes = Include('/users', user_routes)